@@ -1,27 +1,238 @@
 from config.configs import MONGO_CONFIG, REMOTE_MONGO_CONFIG, TEST_MONGO_CONFIG
+from database.indexes import INDEX_SPECS, PIPELINE_QUERIES
 
+import re
 import json
+import time
+import random
 import hashlib
+import functools
+import multiprocessing
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from typing import Dict, Any, List, AsyncIterator, Optional, Tuple
 
 import asyncio
+import bson
+import pandas as pd
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from pymongo import UpdateOne
-from pymongo.errors import AutoReconnect, BulkWriteError
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+"""
+doc_hash versions
+1 - bare sha1 hex of pretty-printed JSON (indent=4)
+2 - 'v2:' + sha1 hex of compact canonical JSON
+Documents still carrying a v1 hash are treated as unchanged when their v1 hash matches,
+and can be re-hashed in place with migrate_doc_hashes()
+"""
+HASH_VERSION        = 2
+HASH_V2_PREFIX      = "v2:"
+
+# Write error codes worth retrying (host unreachable / not primary / shutdown / network timeout ...)
+RETRYABLE_WRITE_CODES = {6, 7, 89, 91, 189, 9001, 10107, 11600, 11602, 13435, 13436}
+
+BULK_COUNT_KEYS = ("nInserted", "nUpserted", "nMatched", "nModified", "nRemoved")
+
+# Server rejects messages over 48MB ; batches stay at a third of that so several can be in flight
+MAX_MESSAGE_BYTES   = 48 * 1000 * 1000
+MAX_BATCH_BYTES     = MAX_MESSAGE_BYTES // 3
+
+HASH_FIELDS = {
+    "measurement"   : {"edd", "add", "onset", "annotations", "notes"},
+    "watermark"     : {"last_utime", "last_job_id"},
+    # Every column scripts/measurements.py syncs, so a row re-pulled by the watermark is rewritten
+    # whenever any of them changed, not only the user_detail ones
+    "measurements"  : {
+        "mobile", "start_ts", "start_test_ts", "contraction_url", "hb_baby_url", "raw_fetal_url",
+        "basic_info", "conclusion", "record_utime", "edd", "add", "onset"
+    },
+}
+
+class AdaptiveBatcher:
+    """
+    Cuts records into batches bounded by encoded BSON bytes and by an op count that adapts to write latency
+    Round-trips well under `target_latency` grow the op count, slower ones shrink it proportionally
+    BSON size is measured exactly on every `sample_every`-th record and estimated from a moving average otherwise
+    """
+
+    def __init__(
+
+            self,
+            initial_ops     : int = 500,
+            min_ops         : int = 50,
+            max_ops         : int = 10000,
+            max_bytes       : int = MAX_BATCH_BYTES,
+            target_latency  : float = 1.0,
+            sample_every    : int = 8
+
+    ):
+
+        self.min_ops        = min(min_ops, initial_ops)
+        self.max_ops        = max(max_ops, initial_ops)
+        self.ops            = initial_ops
+        self.max_bytes      = max_bytes
+        self.target_latency = target_latency
+        self.sample_every   = max(1, sample_every)
+
+        self._avg_size  = None
+        self._seen      = 0
+
+    def size_of(self, doc) -> int:
+
+        sample = self._avg_size is None or self._seen % self.sample_every == 0
+        self._seen += 1
+
+        if not sample:
+            return int(self._avg_size)
+
+        size = len(bson.encode(doc))
+        self._avg_size = size if self._avg_size is None else 0.8 * self._avg_size + 0.2 * size
+
+        return size
+
+    def batches(self, items):
+        """
+        Yield lists of items ; the op limit is read per batch so adjustments from observe() apply immediately
+        """
+
+        batch, n_bytes = [], 0
+
+        for item in items:
+
+            size = self.size_of(item)
+
+            if batch and (len(batch) >= self.ops or n_bytes + size > self.max_bytes):
+                yield batch
+                batch, n_bytes = [], 0
+
+            batch.append(item)
+            n_bytes += size
+
+        if batch:
+            yield batch
+
+    def observe(self, n_ops, seconds) -> None:
+
+        # Small tail batches say little about the round-trip cost of a full one
+        if n_ops < self.ops // 2 or seconds <= 0:
+            return
+
+        if seconds > self.target_latency:
+            ops = int(self.ops * max(0.5, self.target_latency / seconds))
+        elif seconds < self.target_latency / 2:
+            ops = int(self.ops * 1.25) + 1
+        else:
+            return
+
+        self.ops = max(self.min_ops, min(self.max_ops, ops))
+
+class BulkWriter:
+    """
+    Keeps up to `max_in_flight` unordered bulk_writes running while the caller builds the next batch
+    submit() blocks once that many writes are pending, so the producer never runs far ahead
+    Totals of every write are aggregated and returned by close()
+    """
+
+    def __init__(self, coll, flush, max_in_flight=4, on_flush=None):
+
+        self._coll      = coll
+        self._flush     = flush
+        self._on_flush  = on_flush
+        self._sem       = asyncio.Semaphore(max(1, max_in_flight))
+        self._tasks     = set()
+        self._error     = None
+        self.totals     = {**{k: 0 for k in BULK_COUNT_KEYS}, "nOps": 0, "failed_ids": [], "writeErrors": []}
+
+    async def _run(self, ops):
+
+        try:
+            t0  = time.monotonic()
+            res = await self._flush(self._coll, ops)
+
+            if self._on_flush is not None:
+                self._on_flush(len(ops), time.monotonic() - t0)
+
+            for k in (*BULK_COUNT_KEYS, "nOps"):
+                self.totals[k] += res.get(k, 0) or 0
+            self.totals["failed_ids"]  += res.get("failed_ids", [])
+            self.totals["writeErrors"] += res.get("writeErrors", [])
+
+        except Exception as e:
+            self._error = self._error or e
+
+        finally:
+            self._sem.release()
+
+    async def submit(self, ops) -> None:
+
+        if not ops:
+            return
+
+        await self._sem.acquire()
+
+        if self._error is not None:
+            self._sem.release()
+            raise self._error
+
+        task = asyncio.create_task(self._run(ops))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> Dict[str, int]:
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+        if self._error is not None:
+            raise self._error
+
+        return self.totals
+
+class HeartbeatListener(monitoring.ServerHeartbeatListener):
+    """
+    Feeds the driver's server monitor heartbeats (one per server every ~10s) into the connector's liveness state
+    Runs on driver monitor threads, so it only records timestamps
+    """
+
+    def __init__(self):
+        self.last_succeeded = 0.0
+        self.last_failed    = 0.0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.last_succeeded = time.monotonic()
+
+    def failed(self, event):
+        self.last_failed = time.monotonic()
 
 class MongoDBConnector:
 
-    def __init__(self, mode):
+    def __init__(self, mode, process_pool_threshold=5000, process_pool_workers=4, ping_ttl=30.0):
 
         self.mode = mode
+
+        # Batches at least this large are hashed in a process pool instead of a worker thread
+        self.process_pool_threshold = process_pool_threshold
+        self.process_pool_workers   = process_pool_workers
+        self._process_pool          = None
+
+        # resource() pings only when neither a ping nor a heartbeat has confirmed liveness within `ping_ttl` seconds
+        self.ping_ttl   = ping_ttl
+        self._last_ping = 0.0
+        self._heartbeat = HeartbeatListener()
+        self._colls     = {}
+
         config = self._config()
         self._client = AsyncIOMotorClient(
             config["DB_HOST"],
             minPoolSize = 5,
-            maxPoolSize = 50
+            maxPoolSize = 50,
+            event_listeners = [self._heartbeat]
         )
 
     def _config(self) -> Dict[str, Any]:
@@ -37,20 +248,119 @@ class MongoDBConnector:
     def client(self) -> AsyncIOMotorClient:
         return self._client
 
+    def close(self) -> None:
+        """
+        Shut down the hashing process pool (if one was started) and close the client
+        """
+
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+
+        self._client.close()
+
+    def _is_live(self) -> bool:
+
+        hb      = self._heartbeat
+        last_ok = max(self._last_ping, hb.last_succeeded)
+
+        # A failed heartbeat after the last success means the cached state is stale
+        if hb.last_failed > last_ok:
+            return False
+
+        return time.monotonic() - last_ok < self.ping_ttl
+
+    async def ping(self) -> None:
+
+        await self.client.admin.command('ping')
+        self._last_ping = time.monotonic()
+
+    def _collection(self, coll_name):
+
+        coll = self._colls.get(coll_name)
+
+        if coll is None:
+            coll = self.client[self._config()["DB_NAME"]][coll_name]
+            self._colls[coll_name] = coll
+
+        return coll
+
     @asynccontextmanager
     async def resource(self, coll_name):
 
-        config  = self._config()
-        client  = self.client
-        await client.admin.command('ping')
-        db      = client[config["DB_NAME"]]
-        coll    = db[coll_name]
+        if not self._is_live():
+            await self.ping()
+
+        coll = self._collection(coll_name)
 
         try:
             yield coll
         finally:
             pass
 
+    async def ensure_indexes(self, specs: Optional[Dict[str, List[Any]]] = None) -> None:
+        """
+        Create the declared indexes ; existing indexes with the same name and keys are left untouched
+        """
+
+        for coll_name, models in (INDEX_SPECS if specs is None else specs).items():
+
+            if not models:
+                continue
+
+            async with self.resource(coll_name) as coll:
+
+                try:
+                    names = await coll.create_indexes(models)
+                    print(f"[Mongo] {coll_name}: indexes ensured {names}")
+
+                # e.g. same keys under another name, or same name with other options
+                except OperationFailure as e:
+                    print(f"[Mongo] {coll_name}: index spec conflicts with an existing index ({e.code}: {e})")
+
+    @staticmethod
+    def _plan_stages(plan) -> List[str]:
+
+        stages = []
+
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                stages.append(plan["stage"])
+            for v in plan.values():
+                stages += MongoDBConnector._plan_stages(v)
+
+        elif isinstance(plan, list):
+            for v in plan:
+                stages += MongoDBConnector._plan_stages(v)
+
+        return stages
+
+    async def check_query_plans(self, queries: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        explain() each pipeline query shape and flag those whose winning plan contains a COLLSCAN
+        Returns the flagged queries with their plan stages
+        """
+
+        flagged = []
+
+        for q in (queries or PIPELINE_QUERIES):
+
+            async with self.resource(q["coll"]) as coll:
+
+                cursor = coll.find(q["filter"], projection=q.get("projection"))
+                if q.get("sort"):
+                    cursor = cursor.sort(q["sort"])
+
+                explain = await cursor.explain()
+
+            stages = self._plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+
+            if "COLLSCAN" in stages:
+                flagged.append({**q, "stages": stages})
+                print(f"[Mongo] {q['coll']}: COLLSCAN for filter {q['filter']} sort {q.get('sort')} ({' <- '.join(stages)})")
+
+        return flagged
+
     async def stream_all_documents(
 
             self,
@@ -64,7 +374,8 @@ class MongoDBConnector:
 
         async with self.resource(coll_name) as coll:
 
-            sort = sort or [("utime", 1), ("_id", 1)]
+            # Resuming after AutoReconnect continues past the last _id seen, which is only sound in _id order
+            sort = sort or [("_id", 1)]
 
             def make_cursor(base_q: Dict[str, Any], after_id=None):
 
@@ -119,6 +430,329 @@ class MongoDBConnector:
             finally:
                 await cursor.close()
 
+    async def _split_points(self, coll, query, partitions, method="sample", sample_per_partition=32) -> List[Any]:
+        """
+        Return up to partitions-1 ascending _id boundaries splitting the matching documents into similar-sized ranges
+        method="sample": quantiles of a $sample of _ids (cheap, approximate)
+        method="bucketAuto": $bucketAuto on _id (exact, but reads every matching _id)
+        """
+
+        if partitions <= 1:
+            return []
+
+        match = [{"$match": query}] if query else []
+
+        if method == "bucketAuto":
+
+            pipeline = match + [{"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}}]
+            buckets = [b async for b in coll.aggregate(pipeline, allowDiskUse=True)]
+
+            return [b["_id"]["min"] for b in buckets[1:]]
+
+        pipeline = match + [
+            {"$sample": {"size": partitions * sample_per_partition}},
+            {"$project": {"_id": 1}}
+        ]
+
+        try:
+            ids = sorted({d["_id"] async for d in coll.aggregate(pipeline)})
+        except TypeError:
+            # Mixed _id types cannot be ordered client-side ; scan as one range
+            return []
+
+        step = len(ids) / partitions
+        points = [ids[int(step * i)] for i in range(1, partitions)] if ids else []
+
+        return sorted(set(points))
+
+    @staticmethod
+    async def _stream_range(
+
+            coll,
+            query       : Dict[str, Any],
+            lo          : Any,
+            hi          : Any,
+            projection  : Optional[Dict[str, int]],
+            batch_size  : int,
+            max_retries : int = 3
+
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Stream documents with lo <= _id < hi (None = unbounded) in _id order
+        Resumes after the last _id seen when the cursor hits AutoReconnect
+        """
+
+        def make_cursor(after_id=None):
+
+            bounds = {}
+            if lo is not None:
+                bounds["$gte"] = lo
+            if hi is not None:
+                bounds["$lt"] = hi
+            if after_id is not None:
+                bounds.pop("$gte", None)
+                bounds["$gt"] = after_id
+
+            conds = [c for c in (query, {"_id": bounds} if bounds else None) if c]
+            q = conds[0] if len(conds) == 1 else ({"$and": conds} if conds else {})
+
+            return coll.find(
+                filter = q,
+                projection = projection,
+                sort = [("_id", 1)],
+                batch_size = batch_size,
+                no_cursor_timeout = True,
+            )
+
+        cursor  = make_cursor()
+        buf     = []
+        last_id = None
+        retries = 0
+
+        try:
+            while True:
+                try:
+                    doc = await cursor.next()
+                except StopAsyncIteration:
+                    break
+                except AutoReconnect:
+                    if retries >= max_retries:
+                        raise
+                    retries += 1
+                    await cursor.close()
+                    await asyncio.sleep(0.5 * retries)
+                    cursor = make_cursor(after_id=last_id) if last_id is not None else make_cursor()
+                    continue
+
+                buf.append(doc)
+                last_id = doc["_id"]
+
+                if len(buf) >= batch_size:
+                    yield buf
+                    buf = []
+
+            if buf:
+                yield buf
+
+        finally:
+            await cursor.close()
+
+    async def stream_all_documents_parallel(
+
+            self,
+            coll_name   : str,
+            query       : Optional[Dict[str, Any]] = None,
+            projection  : Optional[Dict[str, int]] = None,
+            partitions  : int = 4,
+            ordered     : bool = False,
+            batch_size  : int = 1000,
+            split       : str = "sample"
+
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Scan a collection with one cursor per _id range, merged into a single stream of batches
+        ordered=False: batches are yielded as soon as any partition produces them
+        ordered=True: batches come out in global _id order ; later partitions prefetch a bounded number of batches
+        Each partition resumes independently after AutoReconnect
+        """
+
+        query = query or {}
+
+        async with self.resource(coll_name) as coll:
+
+            points = await self._split_points(coll, query, partitions, method=split)
+            bounds = list(zip([None] + points, points + [None]))
+
+            done    = object()
+            queues  = [asyncio.Queue(maxsize=2) for _ in bounds] if ordered else [asyncio.Queue(maxsize=2 * len(bounds))] * len(bounds)
+
+            async def produce(i, lo, hi):
+                try:
+                    async for batch in self._stream_range(coll, query, lo, hi, projection, batch_size):
+                        await queues[i].put(batch)
+                    await queues[i].put(done)
+                except Exception as e:
+                    await queues[i].put(e)
+
+            tasks = [asyncio.create_task(produce(i, lo, hi)) for i, (lo, hi) in enumerate(bounds)]
+
+            try:
+                if ordered:
+                    for q in queues:
+                        while (item := await q.get()) is not done:
+                            if isinstance(item, Exception):
+                                raise item
+                            yield item
+
+                else:
+                    remaining = len(bounds)
+                    while remaining:
+                        item = await queues[0].get()
+                        if item is done:
+                            remaining -= 1
+                        elif isinstance(item, Exception):
+                            raise item
+                        else:
+                            yield item
+
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def batches_to_dataframe(
+
+            batches     : AsyncIterator[List[Dict[str, Any]]],
+            columns     : Optional[List[str]] = None,
+            dtypes      : Optional[Dict[str, Any]] = None
+
+    ) -> pd.DataFrame:
+        """
+        Build a DataFrame from a stream of document batches, appending each field into its own column buffer
+        Only one batch of dicts is alive at a time ; fields first seen mid-stream are backfilled with None
+        `dtypes` maps columns to pandas dtypes (e.g. 'Int64', pd.CategoricalDtype([...])) ; numeric dtypes coerce unparsable values to NA
+        """
+
+        buffers = {c: [] for c in (columns or [])}
+        n_rows  = 0
+
+        async for batch in batches:
+
+            for doc in batch:
+                for k in doc.keys() - buffers.keys():
+                    buffers[k] = [None] * n_rows
+                for k, col in buffers.items():
+                    col.append(doc.get(k))
+                n_rows += 1
+
+        df = pd.DataFrame(buffers)
+
+        for col, dtype in (dtypes or {}).items():
+
+            if col not in df:
+                continue
+
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[col] = pd.Categorical(df[col], dtype=dtype)
+            elif pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(dtype)):
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+            else:
+                df[col] = df[col].astype(dtype)
+
+        return df
+
+    async def get_dataframe(
+
+            self,
+            coll_name   : str,
+            query       : Optional[Dict[str, Any]] = None,
+            projection  : Optional[Dict[str, Any]] = None,
+            dtypes      : Optional[Dict[str, Any]] = None,
+            batch_size  : Optional[int] = 1000
+
+    ) -> pd.DataFrame:
+        """
+        Load a collection straight into a DataFrame without holding the full list of documents
+        Columns follow the projection order when one is given
+        """
+
+        columns = [k for k, v in (projection or {}).items() if v and k != "_id"] or None
+
+        return await self.batches_to_dataframe(
+            self.stream_all_documents(
+                coll_name,
+                query = query or {},
+                projection = projection,
+                sort = [("_id", 1)],
+                batch_size = batch_size
+            ),
+            columns = columns,
+            dtypes = dtypes
+        )
+
+    async def stream_aggregate(
+
+            self,
+            coll_name   : str,
+            pipeline    : List[Dict[str, Any]],
+            batch_size  : Optional[int] = 1000
+
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+
+        async with self.resource(coll_name) as coll:
+
+            cursor = coll.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+            buf: List[Dict[str, Any]] = []
+
+            try:
+                async for doc in cursor:
+
+                    buf.append(doc)
+
+                    if len(buf) >= batch_size:
+                        yield buf
+                        buf = []
+
+                if buf:
+                    yield buf
+
+            finally:
+                await cursor.close()
+
+    def stream_survey_join(
+
+            self,
+            pre_fields  : List[str],
+            post_fields : List[str],
+            match       : Optional[Dict[str, Any]] = None,
+            post_match  : Optional[Dict[str, Any]] = None,
+            batch_size  : Optional[int] = 1000
+
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Left join patient_presurvey to patient_postsurvey on _id (the mobile) inside MongoDB
+        `match` filters pre-survey documents before the join, `post_match` filters on post-survey fields after it
+        Yields batches of flat rows holding `pre_fields` plus `post_fields` (missing when there is no post-survey)
+        """
+
+        pipeline = []
+
+        if match:
+            pipeline.append({"$match": match})
+
+        pipeline += [
+            {
+                "$lookup": {
+                    "from"          : "patient_postsurvey",
+                    "localField"    : "_id",
+                    "foreignField"  : "_id",
+                    "as"            : "post"
+                }
+            },
+            {
+                "$unwind": {
+                    "path"                          : "$post",
+                    "preserveNullAndEmptyArrays"    : True
+                }
+            }
+        ]
+
+        if post_match:
+            pipeline.append({"$match": {f"post.{k}": v for k, v in post_match.items()}})
+
+        pipeline.append(
+            {
+                "$project": {
+                    "_id": 0,
+                    **{f: 1 for f in pre_fields},
+                    **{f: f"$post.{f}" for f in post_fields}
+                }
+            }
+        )
+
+        return self.stream_aggregate("patient_presurvey", pipeline, batch_size=batch_size)
+
     async def get_all_documents(
 
             self,
@@ -161,127 +795,356 @@ class MongoDBConnector:
                 return [doc async for doc in cursor]
 
     @staticmethod
-    async def flush(coll, ops):
+    def _batcher(batch_size, adaptive) -> AdaptiveBatcher:
+        """
+        `batch_size` is the starting op count ; with adaptive=False it stays fixed and only the byte cap applies
+        """
 
-        try:
-            await coll.bulk_write(ops, ordered=False)
+        if adaptive:
+            return AdaptiveBatcher(initial_ops=batch_size)
 
-        except BulkWriteError as bwe:
-            codes = {e.get("code") for e in (bwe.details or {}).get("writeErrors", [])}
-            if codes & {6, 7, 89, 91, 189, 9001}:
-                await asyncio.sleep(0.5)
-                await coll.bulk_write(ops, ordered=False)
+        return AdaptiveBatcher(initial_ops=batch_size, min_ops=batch_size, max_ops=batch_size)
 
-        except AutoReconnect:
-            await asyncio.sleep(0.5)
-            await coll.bulk_write(ops, ordered=False)
+    @staticmethod
+    def _op_id(op):
+
+        doc = getattr(op, "_filter", None) or getattr(op, "_doc", None) or {}
+        return doc.get("_id")
 
     @staticmethod
-    def _fingerprint(obj, hash_type):
+    async def flush(
 
-        if hash_type == "measurement":
+            coll,
+            ops,
+            max_retries : int = 4,
+            base_delay  : float = 0.5,
+            max_delay   : float = 8.0,
+            ignore_codes: Optional[set] = None
 
-            clean = {
-                k:v for k,v in obj.items() if k in {
-                    "edd",
-                    "add",
-                    "onset",
-                    "annotations",
-                    "notes"
-                }
-            }
+    ) -> Dict[str, Any]:
+        """
+        Unordered bulk_write that retries only the operations that failed with a retryable code,
+        located through the `index` of each writeError, with jittered exponential backoff
+        A connection-level AutoReconnect retries the whole pending batch (upserts are idempotent)
+        Errors with codes in `ignore_codes` are expected outcomes and are not reported as failures
+        Returns bulk write counts plus `nOps`, `failed_ids` and `writeErrors` for operations that finally failed
+        """
 
-        elif hash_type == "watermark":
+        result  = {**{k: 0 for k in BULK_COUNT_KEYS}, "nOps": len(ops), "failed_ids": [], "writeErrors": []}
+        pending = list(ops)
+        ignore  = ignore_codes or set()
 
-            clean = {
-                k: v for k, v in obj.items() if k in {
-                    "last_utime",
-                    "last_job_id",
-                }
-            }
+        def add_counts(details):
+            for k in BULK_COUNT_KEYS:
+                result[k] += details.get(k, 0) or 0
+
+        def fail(op, error):
+            result["failed_ids"].append(MongoDBConnector._op_id(op))
+            result["writeErrors"].append(error)
+
+        for attempt in range(max_retries + 1):
+
+            delay = min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+            try:
+                res = await coll.bulk_write(pending, ordered=False)
+                add_counts(res.bulk_api_result)
+                pending = []
+                break
+
+            except BulkWriteError as bwe:
+
+                details = bwe.details or {}
+                add_counts(details)
+
+                retry = []
+                for err in details.get("writeErrors", []):
+
+                    op   = pending[err["index"]]
+                    code = err.get("code")
+
+                    if code in ignore:
+                        continue
+                    if code in RETRYABLE_WRITE_CODES and attempt < max_retries:
+                        retry.append(op)
+                    else:
+                        fail(op, {"code": code, "errmsg": err.get("errmsg")})
+
+                pending = retry
+
+            except AutoReconnect as e:
+
+                if attempt == max_retries:
+                    for op in pending:
+                        fail(op, {"code": None, "errmsg": f"{type(e).__name__}: {e}"})
+                    pending = []
+                    break
+
+            if not pending:
+                break
+
+            print(f"[Mongo] {coll.name}: retrying {len(pending)}/{len(ops)} ops in {delay:.2f}s (attempt {attempt + 1}/{max_retries})")
+            await asyncio.sleep(delay)
+
+        if result["failed_ids"]:
+            print(f"[Mongo] {coll.name}: {len(result['failed_ids'])} ops failed (codes {sorted({str(e['code']) for e in result['writeErrors']})})")
+
+        return result
+
+    @staticmethod
+    def _fingerprint(obj, hash_type, version=HASH_VERSION):
+
+        clean = {k: v for k, v in obj.items() if k in HASH_FIELDS[hash_type]}
+
+        if version == 1:
+
+            blob = json.dumps(
+                clean, sort_keys=True, indent=4, separators=(',', ': '), default=str
+            ).encode()
+
+            return hashlib.sha1(blob).hexdigest()
 
         blob = json.dumps(
-            clean, sort_keys=True, indent=4, separators=(',', ': '), default=str
+            clean, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str
         ).encode()
 
-        return hashlib.sha1(blob).hexdigest()
+        return HASH_V2_PREFIX + hashlib.sha1(blob).hexdigest()
+
+    @staticmethod
+    def _is_legacy_hash(h) -> bool:
+        return isinstance(h, str) and not h.startswith(HASH_V2_PREFIX)
+
+    @staticmethod
+    def _hash_type(coll_name) -> str:
+
+        if coll_name == "watermarks":
+            return "watermark"
+
+        return "measurements" if coll_name == "measurements" else "measurement"
+
+    @staticmethod
+    def _prepare_hashed_batch(items, coll_name, with_legacy=False):
+        """
+        Split each record into (_id, fields to $set, doc_hash, v1 doc_hash or None)
+        Static and free of connector state so a whole batch is one thread or process pool call
+        """
+
+        hash_type = MongoDBConnector._hash_type(coll_name)
+        prepared  = []
+
+        for item in items:
+
+            to_insert = dict(item)
+
+            if hash_type == "watermark":
+                _id = to_insert.pop("pipeline_name")
+
+            else:
+                _id = to_insert.pop("_id", None)
+
+                # Bookkeeping fields never take part in the hash
+                for k in ("doc_hash", "utime", "ctime"):
+                    to_insert.pop(k, None)
+
+            h        = MongoDBConnector._fingerprint(to_insert, hash_type)
+            h_legacy = MongoDBConnector._fingerprint(to_insert, hash_type, version=1) if with_legacy else None
+
+            prepared.append((_id, to_insert, h, h_legacy))
+
+        return prepared
+
+    async def _prepare_hashed(self, items, coll_name, with_legacy=False):
+
+        if len(items) < self.process_pool_threshold:
+            return await asyncio.to_thread(self._prepare_hashed_batch, items, coll_name, with_legacy)
+
+        if self._process_pool is None:
+            # Never fork : by now Motor's executor and the SSH tunnel have threads running in this process
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._process_pool = ProcessPoolExecutor(
+                max_workers = self.process_pool_workers,
+                mp_context  = multiprocessing.get_context(method)
+            )
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._process_pool, MongoDBConnector._prepare_hashed_batch, items, coll_name, with_legacy
+        )
+
+    @staticmethod
+    def _hashed_update(_id, to_insert, h, conditional, h_legacy=None):
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Conditional filter lets the server skip unchanged docs, at the cost of a duplicate _id insert attempt
+        filt = {
+            "_id": _id,
+            "$or" : [
+                {
+                    "doc_hash" : {
+                        "$nin" : [h, h_legacy] if h_legacy else [h]
+                    }
+                },
+                {
+                    "doc_hash" : {
+                        "$exists" : False
+                    }
+                }
+            ]
+        } if conditional else {"_id": _id}
+
+        return UpdateOne(
+            filt,
+            {
+                "$set" : {
+                    **to_insert,
+                    "doc_hash" : h,
+                    "utime"    : now
+                },
+                "$setOnInsert": {
+                    "ctime" : now
+                }
+            },
+            upsert=True
+        )
 
     async def upsert_documents_hashed(
 
             self,
             records: List[Dict[str, Any]],
             coll_name: str,
-            batch_size: Optional[int] = 500
-
-    ) -> None:
+            batch_size: Optional[int] = 500,
+            prefilter: bool = False,
+            max_in_flight: Optional[int] = 4,
+            adaptive: bool = True
+
+    ) -> Dict[str, int]:
+        """
+        Upsert records whose doc_hash changed
+        prefilter=False: send every record with a doc_hash $ne filter and let the server skip unchanged ones
+        prefilter=True: fetch {_id, doc_hash} for each batch first and only send new or changed records
+        Returns counts of unchanged, updated, inserted and failed records, plus the failed _ids
+        """
+
+        counts  = {"unchanged": 0, "updated": 0, "inserted": 0}
+        new_ids = set()
 
         async with self.resource(coll_name) as coll:
 
-            ops = []
+            # On the conditional path a duplicate _id (11000) means the stored hash already matched
+            flush  = self.flush if prefilter else functools.partial(self.flush, ignore_codes={11000})
+            batcher = self._batcher(batch_size, adaptive)
+            writer  = BulkWriter(coll, flush, max_in_flight=max_in_flight, on_flush=batcher.observe)
 
-            for item in records:
+            for chunk in batcher.batches(records):
 
-                to_insert = dict(item)
+                # Server-side filtering cannot tell which documents still carry v1 hashes, so both are computed
+                batch = await self._prepare_hashed(chunk, coll_name, with_legacy=not prefilter)
 
-                if coll_name == "watermarks":
+                if not prefilter:
 
-                    _id = item["pipeline_name"]
+                    await writer.submit([
+                        self._hashed_update(_id, to_insert, h, conditional=True, h_legacy=h_legacy)
+                        for _id, to_insert, h, h_legacy in batch
+                    ])
+                    continue
 
-                    to_insert.pop("pipeline_name")
+                existing = {
+                    doc["_id"]: doc.get("doc_hash") async for doc in coll.find(
+                        {"_id": {"$in": [_id for _id, _, _, _ in batch]}},
+                        projection = {"doc_hash": 1}
+                    )
+                }
 
-                    h = await asyncio.to_thread(self._fingerprint, to_insert, "watermark")
+                hash_type = self._hash_type(coll_name)
 
-                else:
+                ops = []
+                for _id, to_insert, h, _ in batch:
 
-                    _id = item.get("_id")
+                    stored = existing.get(_id)
 
-                    to_insert.pop("_id")
+                    if _id not in existing:
+                        counts["inserted"] += 1
+                        new_ids.add(_id)
+                    elif stored == h:
+                        counts["unchanged"] += 1
+                        continue
+                    elif self._is_legacy_hash(stored) and stored == self._fingerprint(to_insert, hash_type, version=1):
+                        # Unchanged under the v1 scheme ; left for migrate_doc_hashes instead of rewritten here
+                        counts["unchanged"] += 1
+                        continue
+                    else:
+                        counts["updated"] += 1
 
-                    try:
-                        to_insert.pop("doc_hash"); to_insert.pop('utime') ; to_insert.pop('ctime')
-                    except KeyError:
-                        pass
-
-                    h = await asyncio.to_thread(self._fingerprint, to_insert, "measurement")
-
-                op = UpdateOne(
-                    {
-                        "_id": _id,
-                        "$or" : [
-                            {
-                                "doc_hash" : {
-                                    "$ne" : h
-                                }
-                            },
-                            {
-                                "doc_hash" : {
-                                    "$exists" : False
-                                }
-                            }
-                        ]
-
-                    },
-                    {
-                        "$set" : {
-                            **to_insert,
-                            "doc_hash" : h,
-                            "utime"    : datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        },
-                        "$setOnInsert": {
-                            "ctime" : datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                    },
-                    upsert=True
-                )
+                    ops.append(self._hashed_update(_id, to_insert, h, conditional=False))
+
+                await writer.submit(ops)
+
+            totals = await writer.close()
+
+        failed = len(totals["failed_ids"])
+
+        if prefilter:
+            # Counted before sending ; move failed writes out of updated/inserted
+            counts["failed"] = failed
+            n_new_failed = sum(1 for _id in totals["failed_ids"] if _id in new_ids)
+            counts["inserted"] -= n_new_failed
+            counts["updated"]  -= failed - n_new_failed
+        else:
+            counts["inserted"]  = totals["nUpserted"]
+            counts["updated"]   = totals["nModified"]
+            counts["unchanged"] = totals["nOps"] - totals["nUpserted"] - totals["nModified"] - failed
+            counts["failed"]    = failed
+
+        counts["failed_ids"] = totals["failed_ids"]
+
+        return counts
+
+    async def migrate_doc_hashes(
+
+            self,
+            coll_name: str,
+            batch_size: Optional[int] = 500,
+            limit: Optional[int] = None
+
+    ) -> int:
+        """
+        Re-hash documents still carrying a v1 doc_hash to the current version, touching only doc_hash
+        `limit` caps how many documents are migrated per call so the rewrite can be spread over several runs
+        Returns the number of documents migrated
+        """
+
+        hash_type = self._hash_type(coll_name)
+        query     = {"doc_hash": {"$exists": True, "$not": re.compile(f"^{re.escape(HASH_V2_PREFIX)}")}}
+        migrated  = 0
 
-                ops.append(op)
+        async with self.resource(coll_name) as coll:
+
+            cursor = coll.find(query, batch_size=batch_size)
+            if limit:
+                cursor = cursor.limit(limit)
+
+            ops = []
+            async for doc in cursor:
+
+                old_h = doc["doc_hash"]
+                new_h = self._fingerprint(doc, hash_type)
+
+                # Skip if the document was rewritten since it was read
+                ops.append(UpdateOne({"_id": doc["_id"], "doc_hash": old_h}, {"$set": {"doc_hash": new_h}}))
 
                 if len(ops) >= batch_size:
-                    await self.flush(coll, ops)
+                    res = await self.flush(coll, ops)
+                    migrated += res.get("nModified", 0)
                     ops = []
 
             if ops:
-                await self.flush(coll, ops)
+                res = await self.flush(coll, ops)
+                migrated += res.get("nModified", 0)
+
+        print(f"[Mongo] {coll_name}: {migrated} doc_hash values migrated to v{HASH_VERSION}")
+
+        return migrated
 
     async def upsert_documents(
 
@@ -289,36 +1152,40 @@ class MongoDBConnector:
             records: List[Dict[str, Any]],
             coll_name: str,
             id_fields: List[str],
-            batch_size: Optional[int] = 1000
+            batch_size: Optional[int] = 1000,
+            max_in_flight: Optional[int] = 4,
+            adaptive: bool = True
 
-    ) -> None:
+    ) -> Dict[str, int]:
 
         async with self.resource(coll_name) as coll:
 
-            ops = []
+            batcher = self._batcher(batch_size, adaptive)
+            writer  = BulkWriter(coll, self.flush, max_in_flight=max_in_flight, on_flush=batcher.observe)
 
-            for item in records:
+            for batch in batcher.batches(records):
 
-                _id = ''.join([item[f] for f in id_fields])
+                ops = []
 
-                op = UpdateOne(
-                    {
-                        "_id": _id
-                    },
-                    {
-                        "$set": item
-                    },
-                    upsert=True
-                )
+                for item in batch:
 
-                ops.append(op)
+                    _id = ''.join([item[f] for f in id_fields])
 
-                if len(ops) >= batch_size:
-                    await self.flush(coll, ops)
-                    ops = []
+                    op = UpdateOne(
+                        {
+                            "_id": _id
+                        },
+                        {
+                            "$set": item
+                        },
+                        upsert=True
+                    )
 
-            if ops:
-                await self.flush(coll, ops)
+                    ops.append(op)
+
+                await writer.submit(ops)
+
+            return await writer.close()
 
     async def delete_document(
 
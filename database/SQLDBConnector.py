@@ -1,27 +1,217 @@
 from config.configs import DB_CONFIG
 
+import time
+import asyncio
+import threading
 import pandas as pd
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
 
 from sshtunnel import SSHTunnelForwarder
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text, bindparam
 from sqlalchemy.engine import URL
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+# MySQL client errors meaning the connection itself is gone (server gone away / lost during query / lost connection)
+CONNECTION_LOST_ERRNOS = {2006, 2013, 2055}
 
 class SQLDBConnector:
 
-    def __init__(self):
-        pass
+    def __init__(self, health_check_interval=30, max_reconnects=3):
 
-    @contextmanager
-    def ssh_tunnel(self):
+        # Long-lived tunnel and engine, only set between start() and close()
+        self._tunnel = None
+        self._engine = None
+
+        # Queries may run from worker threads (asyncio.to_thread), so (re)connects are serialized
+        self._lock                  = threading.RLock()
+        self._last_health_check     = 0.0
+        self.health_check_interval  = health_check_interval
+        self.max_reconnects         = max_reconnects
 
-        tunnel = SSHTunnelForwarder(
+    def _make_tunnel(self) -> SSHTunnelForwarder:
+
+        return SSHTunnelForwarder(
             ssh_address_or_host=(DB_CONFIG['SSH_HOST'], DB_CONFIG['SSH_PORT']),
             ssh_username=DB_CONFIG['SSH_USER'],
             ssh_pkey=DB_CONFIG['SSH_PKEY'],
             remote_bind_address=(DB_CONFIG['DB_HOST'], DB_CONFIG['DB_PORT'])
         )
 
+    @staticmethod
+    def _make_engine(local_bind_port):
+
+        url = URL.create(
+            drivername="mysql+pymysql",
+            username=DB_CONFIG["DB_USER"],
+            password=DB_CONFIG["DB_PASS"],
+            host="127.0.0.1",
+            port=local_bind_port,
+            database=DB_CONFIG["DB_NAME"],
+            query={"charset": "utf8mb4"},
+        )
+
+        return create_engine(
+            url,
+            pool_size=8,
+            max_overflow=8,
+            pool_recycle=3600,
+            pool_pre_ping=True,
+            future=True,
+            connect_args={
+                "connect_timeout": 10,
+            }
+        )
+
+    @property
+    def is_started(self) -> bool:
+        return self._engine is not None
+
+    def start(self) -> "SQLDBConnector":
+        """
+        Open one SSH tunnel and one pooled engine that are reused by every query until close()
+        """
+
+        with self._lock:
+
+            if self.is_started:
+                return self
+
+            self._open()
+
+        return self
+
+    def _open(self) -> None:
+
+        tunnel = self._make_tunnel()
+        tunnel.start()
+        print(f"SSH TUNNEL STARTED ON PORT {tunnel.local_bind_port}")
+
+        self._tunnel            = tunnel
+        self._engine            = self._make_engine(tunnel.local_bind_port)
+        self._last_health_check = time.monotonic()
+
+    def _teardown(self) -> None:
+
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+
+        if self._tunnel is not None:
+            try:
+                self._tunnel.close()
+            except Exception as e:
+                print(f"SSH TUNNEL CLOSE FAILED ({type(e).__name__}: {e})")
+            self._tunnel = None
+
+    def close(self) -> None:
+
+        with self._lock:
+            self._teardown()
+
+    def reconnect(self) -> None:
+        """
+        Tear down the tunnel and engine and open new ones (the local bind port may change)
+        """
+
+        with self._lock:
+
+            print("SSH TUNNEL RECONNECTING")
+            self._teardown()
+
+            for attempt in range(1, self.max_reconnects + 1):
+
+                try:
+                    self._open()
+                    return
+
+                except Exception as e:
+                    print(f"SSH TUNNEL RECONNECT {attempt}/{self.max_reconnects} FAILED ({type(e).__name__}: {e})")
+                    self._teardown()
+                    if attempt == self.max_reconnects:
+                        raise
+                    time.sleep(min(30, 2 ** attempt))
+
+    def _reconnect_if_current(self, engine) -> None:
+
+        # Another thread may already have replaced the engine that failed
+        with self._lock:
+            if self._engine is engine or not self.is_started:
+                self.reconnect()
+
+    def _connection_lost(self, e) -> bool:
+        """
+        True if `e` means the connection or the tunnel is gone ; pymysql also raises OperationalError
+        for ordinary server errors (unknown column, lock wait timeout, deadlock), which must not
+        tear down the tunnel other queries are using
+        """
+
+        if getattr(e, "connection_invalidated", False):
+            return True
+
+        orig = getattr(e, "orig", None)
+        if orig is not None and orig.args and orig.args[0] in CONNECTION_LOST_ERRNOS:
+            return True
+
+        tunnel = self._tunnel
+        return tunnel is not None and not tunnel.is_active
+
+    def health_check(self) -> bool:
+        """
+        True if the tunnel transport is up and MySQL answers `SELECT 1` through it
+        """
+
+        with self._lock:
+
+            if not self.is_started:
+                return False
+
+            try:
+                if not self._tunnel.is_active:
+                    return False
+
+                with self._engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+
+            except Exception:
+                return False
+
+            self._last_health_check = time.monotonic()
+            return True
+
+    def ensure_healthy(self) -> None:
+        """
+        Health-check the long-lived connection at most every `health_check_interval` seconds
+        and re-establish it if the check fails
+        """
+
+        with self._lock:
+
+            if not self.is_started:
+                return
+
+            if not self._tunnel.is_active:
+                self.reconnect()
+                return
+
+            if time.monotonic() - self._last_health_check < self.health_check_interval:
+                return
+
+            if not self.health_check():
+                self.reconnect()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def ssh_tunnel(self):
+
+        tunnel = self._make_tunnel()
+
         try:
             tunnel.start()
             local_bind_port = tunnel.local_bind_port
@@ -34,29 +224,14 @@ class SQLDBConnector:
     @contextmanager
     def connect(self):
 
+        # Reuse the long-lived engine when the connector has been started
+        if self.is_started:
+            yield self._engine
+            return
+
         with self.ssh_tunnel() as local_bind_port:
 
-            url = URL.create(
-                drivername="mysql+pymysql",
-                username=DB_CONFIG["DB_USER"],
-                password=DB_CONFIG["DB_PASS"],
-                host="127.0.0.1",
-                port=local_bind_port,
-                database=DB_CONFIG["DB_NAME"],
-                query={"charset": "utf8mb4"},
-            )
-
-            engine = create_engine(
-                url,
-                pool_size=8,
-                max_overflow=8,
-                pool_recycle=3600,
-                pool_pre_ping=True,
-                future=True,
-                connect_args={
-                    "connect_timeout": 10,
-                }
-            )
+            engine = self._make_engine(local_bind_port)
 
             try:
                 yield engine
@@ -64,5 +239,146 @@ class SQLDBConnector:
                 engine.dispose()
 
     def query_to_dataframe(self, query, chunksize=None):
-        with self.connect() as engine:
+
+        if not self.is_started:
+            with self.connect() as engine:
+                return pd.read_sql(query, engine, chunksize=chunksize)
+
+        self.ensure_healthy()
+        engine = self._engine
+
+        try:
             return pd.read_sql(query, engine, chunksize=chunksize)
+
+        # Tunnel dropped between health checks ; rebuild it and retry once
+        except (OperationalError, InterfaceError) as e:
+            if not self._connection_lost(e):
+                raise
+            print(f"MYSQL CONNECTION LOST ({type(e).__name__}), RETRYING")
+            self._reconnect_if_current(engine)
+            return pd.read_sql(query, self._engine, chunksize=chunksize)
+
+    def iter_query(
+
+            self,
+            query       : str,
+            chunksize   : int = 5000,
+            params      : Optional[Dict[str, Any]] = None,
+            as_records  : bool = False
+
+    ) -> Iterator[Union[pd.DataFrame, List[Dict[str, Any]]]]:
+        """
+        Stream a result set in chunks of `chunksize` rows through a server-side (unbuffered) cursor
+        Yields DataFrames, or lists of dicts if `as_records`, so at most one chunk is held in memory
+        The connection stays checked out until the iterator is exhausted or closed
+        """
+
+        if self.is_started:
+            self.ensure_healthy()
+
+        with self.connect() as engine:
+
+            with engine.connect() as conn:
+
+                # stream_results makes the pymysql dialect use an SSCursor instead of buffering every row
+                conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+                result = conn.execute(text(query), params or {})
+                columns = list(result.keys())
+
+                for rows in result.partitions(chunksize):
+
+                    if as_records:
+                        yield [dict(zip(columns, row)) for row in rows]
+                    else:
+                        yield pd.DataFrame.from_records(rows, columns=columns)
+
+    async def aiter_query(
+
+            self,
+            query       : str,
+            chunksize   : int = 5000,
+            params      : Optional[Dict[str, Any]] = None,
+            as_records  : bool = False
+
+    ) -> AsyncIterator[Union[pd.DataFrame, List[Dict[str, Any]]]]:
+        """
+        Async wrapper over iter_query ; each chunk is fetched in a worker thread so the event loop stays free
+        """
+
+        it      = self.iter_query(query, chunksize=chunksize, params=params, as_records=as_records)
+        done    = object()
+        pending = None
+
+        try:
+            while True:
+                # Shielded so a cancelled consumer leaves the worker thread's next() to finish on its own
+                pending = asyncio.ensure_future(asyncio.to_thread(next, it, done))
+                chunk   = await asyncio.shield(pending)
+                pending = None
+
+                if chunk is done:
+                    break
+                yield chunk
+
+        finally:
+            # Closing a generator still running next() in a worker raises ValueError and leaks the cursor ;
+            # wait for that chunk first, then close so the server-side cursor and connection are released
+            if pending is not None:
+                try:
+                    await pending
+                except BaseException:
+                    pass
+
+            await asyncio.to_thread(it.close)
+
+    def query_in_chunks(
+
+            self,
+            query       : str,
+            key         : str,
+            values      : List[Any],
+            chunk_size  : int = 500,
+            max_workers : int = 4,
+            params      : Optional[Dict[str, Any]] = None
+
+    ) -> pd.DataFrame:
+        """
+        Run `query` with its `IN :<key>` list bound in chunks of `chunk_size` values
+        Chunks run concurrently on the engine pool (keep `max_workers` <= pool_size) and are concatenated in order
+        Every chunk of the same size reuses the same statement text, unlike one inlined `IN (...)` of every value
+        """
+
+        values = list(dict.fromkeys(values))
+        chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+        if not chunks:
+            return pd.DataFrame()
+
+        stmt = text(query).bindparams(bindparam(key, expanding=True))
+
+        if self.is_started:
+            self.ensure_healthy()
+
+        with self.connect() as engine:
+
+            def read_chunk(chunk):
+
+                chunk_params = {**(params or {}), key: chunk}
+                chunk_engine = self._engine if self.is_started else engine
+
+                try:
+                    return pd.read_sql(stmt, chunk_engine, params=chunk_params)
+
+                except (OperationalError, InterfaceError) as e:
+                    if not self.is_started or not self._connection_lost(e):
+                        raise
+                    print(f"MYSQL CONNECTION LOST ({type(e).__name__}), RETRYING CHUNK")
+                    self._reconnect_if_current(chunk_engine)
+                    return pd.read_sql(stmt, self._engine, params=chunk_params)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as ex:
+                frames = list(ex.map(read_chunk, chunks))
+
+        print(f"[MySQL] {len(values)} keys queried in {len(chunks)} chunks")
+
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,49 @@
+"""
+Secondary indexes for the collections this pipeline writes and reads
+Applied idempotently at startup by MongoDBConnector.ensure_indexes()
+
+Every query the pipeline issues is keyed on _id (the mobile for patients and surveys, the record id
+for measurements), which the default _id_ index already covers, so none is declared today ; add an
+IndexModel here together with the PIPELINE_QUERIES shape that needs it
+"""
+INDEX_SPECS = {}
+
+"""
+Shapes of the queries the pipeline issues, checked with explain() by MongoDBConnector.check_query_plans()
+Values are placeholders, only the plan shape matters
+"""
+PIPELINE_QUERIES = [
+    # upsert_documents / upsert_documents_hashed : one UpdateOne per document, by _id
+    {
+        "coll"      : "patients_unified",
+        "filter"    : {"_id": ""},
+    },
+    # stream_survey_join : the $lookup probes patient_postsurvey by _id once per pre-survey document
+    # (the pre-survey side is read in full by design)
+    {
+        "coll"      : "patient_postsurvey",
+        "filter"    : {"_id": ""},
+    },
+    # upsert_documents_hashed(prefilter=True) : stored hashes of a batch
+    {
+        "coll"      : "measurements",
+        "filter"    : {"_id": {"$in": [0]}},
+        "projection": {"doc_hash": 1},
+    },
+    # upsert_documents_hashed(prefilter=False) : conditional update
+    {
+        "coll"      : "measurements",
+        "filter"    : {"_id": 0, "$or": [{"doc_hash": {"$nin": [""]}}, {"doc_hash": {"$exists": False}}]},
+    },
+    # stream_all_documents / get_dataframe / stream_all_documents_parallel : _id ranges in _id order
+    {
+        "coll"      : "measurements",
+        "filter"    : {"_id": {"$gte": 0, "$lt": 0}},
+        "sort"      : [("_id", 1)],
+    },
+    # read_watermark
+    {
+        "coll"      : "watermarks",
+        "filter"    : {"_id": ""},
+    },
+]
@@ -1,5 +1,5 @@
-HISTORICAL = """
-SELECT
+# Columns synced by scripts/measurements.py ; sync_utime is the later of the record's and its user_detail row's utime
+_HISTORICAL_COLUMNS = """
 uu.mobile,
 r.id,
 r.start_ts,
@@ -11,20 +11,46 @@ r.basic_info,
 r.conclusion,
 tt.expected_born_date,
 tt.end_born_ts,
-r.utime
-FROM
-extant_future_user.user AS uu
-INNER JOIN
-extant_future_data.origin_data_record AS r
-ON uu.id = r.user_id
-INNER JOIN
-extant_future_user.user_detail AS tt
-ON uu.id = tt.uid
+r.utime,
+GREATEST(r.utime, COALESCE(tt.utime, r.utime)) AS sync_utime
+"""
+
+_HISTORICAL_FILTERS = """
 AND r.contraction_url <> ''
 AND r.hb_baby_url <> ''
 AND tt.end_born_ts IS NOT NULL
 AND tt.end_born_ts <> 0
-AND r.utime > '{last_utime}'
+"""
+
+"""
+Rows whose sync_utime is at or past the watermark, as two disjoint index-driven branches
+(GREATEST(a, b) >= w  <=>  a >= w OR b >= w) : records changed since the watermark via
+origin_data_record(utime), and older records of users whose user_detail changed via user_detail(utime)
+The keyset and the sort then only run over that delta
+"""
+HISTORICAL = f"""
+SELECT d.*
+FROM
+(
+    SELECT {_HISTORICAL_COLUMNS}
+    FROM extant_future_data.origin_data_record AS r
+    INNER JOIN extant_future_user.user AS uu ON uu.id = r.user_id
+    INNER JOIN extant_future_user.user_detail AS tt ON tt.uid = uu.id
+    WHERE r.utime >= :last_utime
+    {_HISTORICAL_FILTERS}
+
+    UNION ALL
+
+    SELECT {_HISTORICAL_COLUMNS}
+    FROM extant_future_user.user_detail AS tt
+    INNER JOIN extant_future_user.user AS uu ON uu.id = tt.uid
+    INNER JOIN extant_future_data.origin_data_record AS r ON r.user_id = uu.id
+    WHERE tt.utime >= :last_utime
+    AND r.utime < :last_utime
+    {_HISTORICAL_FILTERS}
+) AS d
+WHERE d.sync_utime > :last_utime OR (d.sync_utime = :last_utime AND d.id > :last_job_id)
+ORDER BY d.sync_utime, d.id
 """
 
 RECRUITED = """
@@ -61,7 +87,7 @@ ON u.id = r.user_id
 WHERE
 u.mobile
 IN
-({mobile_query_str})
+:mobiles
 """
 
 HISTORICAL_PATIENTS_QUERY = """
@@ -90,17 +116,22 @@ JOIN
 	o2.conclusion
 	FROM
 	(
+		-- Restricted to the chunk's users ; unfiltered, every chunk would aggregate the whole table
 		SELECT
-		user_id,
-		MIN(start_ts) AS earliest,
-		MAX(start_ts) AS latest
-		FROM extant_future_data.origin_data_record
-		GROUP BY user_id
+		r1.user_id,
+		MIN(r1.start_ts) AS earliest,
+		MAX(r1.start_ts) AS latest
+		FROM extant_future_data.origin_data_record AS r1
+		JOIN extant_future_user.user AS u1 ON u1.id = r1.user_id
+		WHERE u1.mobile IN :mobiles
+		GROUP BY r1.user_id
 	) AS o1
 	JOIN
 	(
-		SELECT user_id, start_ts, basic_info, conclusion
-		FROM extant_future_data.origin_data_record
+		SELECT r2.user_id, r2.start_ts, r2.basic_info, r2.conclusion
+		FROM extant_future_data.origin_data_record AS r2
+		JOIN extant_future_user.user AS u2 ON u2.id = r2.user_id
+		WHERE u2.mobile IN :mobiles
 	) AS o2
 	ON o1.user_id = o2.user_id AND o1.earliest = o2.start_ts
 ) AS oo ON uu.uid = oo.user_id
@@ -108,5 +139,5 @@ LEFT JOIN extant_future_user.medical_record AS mm ON oo.user_id = mm.user_id AND
 WHERE
 u.mobile
 IN
-({mobile_query_str})
+:mobiles
 """
\ No newline at end of file
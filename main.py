@@ -1,8 +1,78 @@
+from database.SQLDBConnector import SQLDBConnector
+from database.MongoDBConnector import MongoDBConnector
+from scripts.upsert_surveys import upsert
+from scripts.recruited import recruited
+from scripts.historical import historical_records, upsert_historical
+from scripts.measurements import measurements
+from utils.scheduler import Stage, run_stages
+
 import argparse
-import subprocess
+import asyncio
 
 from datetime import datetime
 
+def build_stages(mongo, sql, date):
+    """
+    Inputs/outputs name the files, MySQL and Mongo collections each stage reads and writes
+    A stage waits only for the stages producing one of its inputs ; stages writing the same output
+    run in the order listed, so only the historical upsert waits for recruited, not its MySQL/Excel work
+    """
+
+    # Hands the consolidated historical records from the fetch stage to the upsert stage
+    handoff = {}
+
+    async def fetch_historical():
+        handoff["historical"] = await historical_records(sql=sql)
+
+    return [
+        Stage(
+            name    = "upsert_surveys",
+            func    = lambda: upsert(mongo=mongo, date=date),
+            inputs  = [f"datasets/{date}_pre_survey.csv", f"datasets/{date}_post_survey.csv"],
+            outputs = ["mongo:patient_presurvey", "mongo:patient_postsurvey"]
+        ),
+        Stage(
+            name    = "recruited",
+            func    = lambda: recruited(mongo=mongo, sql=sql),
+            inputs  = ["mongo:patient_presurvey", "mongo:patient_postsurvey", "mysql"],
+            outputs = ["mongo:patients_unified"]
+        ),
+        Stage(
+            name    = "historical",
+            func    = fetch_historical,
+            inputs  = ["datasets/historical_metadata.xlsx", "mysql"],
+            outputs = ["memory:historical_records"]
+        ),
+        Stage(
+            name    = "upsert_historical",
+            func    = lambda: upsert_historical(mongo=mongo, new_records=handoff.pop("historical")),
+            inputs  = ["memory:historical_records"],
+            outputs = ["mongo:patients_unified"]
+        ),
+        Stage(
+            name    = "measurements",
+            func    = lambda: measurements(mongo=mongo, sql=sql),
+            inputs  = ["mysql", "mongo:watermarks"],
+            outputs = ["mongo:measurements", "mongo:watermarks"]
+        ),
+    ]
+
+async def run_pipeline(mode, date, concurrency):
+
+    # One Mongo client pool and one SSH tunnel + engine shared by every stage
+    mongo = MongoDBConnector(mode=mode)
+
+    with SQLDBConnector() as sql:
+
+        try:
+            await mongo.ensure_indexes()
+            await mongo.check_query_plans()
+
+            await run_stages(build_stages(mongo, sql, date), max_concurrency=concurrency)
+
+        finally:
+            mongo.close()
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -11,13 +81,13 @@ def main():
 
     parser.add_argument('--date', type=str, required=False, default=datetime.now().strftime('%y%m%d'))
 
+    parser.add_argument('--concurrency', type=int, required=False, default=2)
+
     args = parser.parse_args()
 
-    mode = args.mode ; date = args.date
+    mode = args.mode ; date = args.date ; concurrency = args.concurrency
 
-    subprocess.run(['python', '-m', 'scripts.upsert_surveys', '--mode', mode, '--date', date], check=True)
-    subprocess.run(['python', '-m', 'scripts.recruited', '--mode', mode], check=True)
-    subprocess.run(['python', '-m', 'scripts.historical', '--mode', mode], check=True)
+    asyncio.run(run_pipeline(mode, date, concurrency))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
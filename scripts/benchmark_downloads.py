@@ -0,0 +1,128 @@
+from utils.query import TraceDownloader
+
+import argparse
+import asyncio
+import gzip
+import random
+import threading
+import time
+
+from aiohttp import web
+
+"""
+Throughput of TraceDownloader with gunzip/parsing inline on the event loop vs offloaded to a worker pool
+Traces are served from a local HTTP server running on its own thread and event loop,
+so only the client side competes for the loop being measured
+
+python -m scripts.benchmark_downloads --traces 300 --samples 200000 --workers 4
+"""
+
+def make_trace(n_samples, seed):
+
+    rng = random.Random(seed)
+    return gzip.compress("\n".join(str(rng.randint(0, 240)) for _ in range(n_samples)).encode())
+
+def start_server(bodies):
+
+    loop    = asyncio.new_event_loop()
+    ready   = threading.Event()
+    state   = {}
+
+    async def handle(request):
+        i = int(request.match_info["i"])
+        return web.Response(body=bodies[i % len(bodies)])
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/trace/{i}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        state["port"]   = site._server.sockets[0].getsockname()[1]
+        state["runner"] = runner
+        ready.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(state["runner"].cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return state["port"], stop
+
+async def measure(urls_indexed, decode_workers, as_array):
+
+    # Worst delay of a 10ms ticker ; how long the loop was blocked at a stretch
+    max_lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal max_lag
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - t0 - 0.01)
+
+    tick = asyncio.create_task(ticker())
+
+    t0 = time.perf_counter()
+    async with TraceDownloader(decode_workers=decode_workers) as dl:
+        results = await dl.fetch_all(urls_indexed, as_array=as_array)
+    elapsed = time.perf_counter() - t0
+
+    running = False
+    await tick
+
+    failed = sum(1 for r in results if r[1] is None)
+
+    return elapsed, max_lag, failed
+
+async def benchmark(n_traces, n_samples, workers, repeats):
+
+    bodies = [make_trace(n_samples, seed) for seed in range(8)]
+    port, stop = start_server(bodies)
+
+    urls_indexed = [(i, f"http://127.0.0.1:{port}/trace/{i}") for i in range(n_traces)]
+    compressed_mb = sum(len(bodies[i % len(bodies)]) for i in range(n_traces)) / 1e6
+
+    print(f"{n_traces} traces x {n_samples} samples ({compressed_mb:.1f} MB compressed)")
+    print(f"{'mode':<10}{'offload':<12}{'seconds':>10}{'traces/s':>12}{'max loop lag (ms)':>20}{'failed':>8}")
+
+    try:
+        for as_array in (False, True):
+            for decode_workers in (0, workers):
+
+                best = None
+                for _ in range(repeats):
+                    run = await measure(urls_indexed, decode_workers, as_array)
+                    best = run if best is None or run[0] < best[0] else best
+
+                elapsed, max_lag, failed = best
+                mode    = "array" if as_array else "text"
+                offload = f"{decode_workers} workers" if decode_workers else "inline"
+
+                print(f"{mode:<10}{offload:<12}{elapsed:>10.2f}{n_traces / elapsed:>12.1f}{max_lag * 1000:>20.1f}{failed:>8}")
+
+    finally:
+        stop()
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--traces", type=int, required=False, default=300)
+    parser.add_argument("--samples", type=int, required=False, default=200000)
+    parser.add_argument("--workers", type=int, required=False, default=4)
+    parser.add_argument("--repeats", type=int, required=False, default=3)
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args.traces, args.samples, args.workers, args.repeats))
+
+if __name__ == "__main__":
+    main()
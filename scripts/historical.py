@@ -7,27 +7,33 @@ import argparse
 import asyncio
 import pandas as pd
 from pathlib import Path
+from typing import Any, Dict, List
 
-async def historical():
+async def historical_records(
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", type=str, required=True, choices=["local", "remote", 'test'])
-    mode = parser.parse_args().mode
+        sql     : SQLDBConnector
 
-    print(f"---HISTORICAL ({mode})---")
+) -> List[Dict[str, Any]]:
+    """
+    Consolidated historical patient records from the Excel metadata and MySQL ; touches no Mongo collection,
+    so the scheduler can run it alongside the survey chain and order only the upsert after recruited
+    """
 
-    sql     = SQLDBConnector()
-    mongo   = MongoDBConnector(mode=mode)
+    print("---HISTORICAL---")
 
     ROOT                = Path(__file__).parent.parent
-    hist_df             = pd.read_excel(ROOT / "datasets" / "historical_metadata.xlsx")
+    hist_df             = await asyncio.to_thread(pd.read_excel, ROOT / "datasets" / "historical_metadata.xlsx")
     hist_df['mobile']   = hist_df['mobile'].astype(str)
 
     print(f"[Excel] {len(hist_df)} patients loaded")
 
-    mobile_query_str = ",".join([f"'{i}'" for i in hist_df["mobile"].tolist()])
-
-    hist_sql = sql.query_to_dataframe(query=HISTORICAL_PATIENTS_QUERY.format(mobile_query_str=mobile_query_str))
+    # Off the event loop so stages scheduled alongside this one keep running
+    hist_sql = await asyncio.to_thread(
+        sql.query_in_chunks,
+        query   = HISTORICAL_PATIENTS_QUERY,
+        key     = "mobiles",
+        values  = hist_df["mobile"].tolist()
+    )
 
     print(f"[MySQL] {len(hist_sql)} measurements fetched")
 
@@ -95,9 +101,35 @@ async def historical():
 
         new_records.append(record)
 
-        await mongo.upsert_documents(new_records, coll_name='patients_unified', id_fields=['mobile'])
+    return new_records
+
+async def upsert_historical(
+
+        mongo       : MongoDBConnector,
+        new_records : List[Dict[str, Any]]
+
+) -> None:
+
+    await mongo.upsert_documents(new_records, coll_name='patients_unified', id_fields=['mobile'])
+
+    print(f"Historical ({mongo.mode}): {len(new_records)} consolidated patients upserted")
+
+async def historical(
+
+        mongo   : MongoDBConnector,
+        sql     : SQLDBConnector
+
+) -> None:
+
+    await upsert_historical(mongo, await historical_records(sql))
+
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, required=True, choices=["local", "remote", 'test'])
+    mode = parser.parse_args().mode
 
-    print(f"Historical: {len(new_records)} consolidated patients upserted")
+    await historical(mongo=MongoDBConnector(mode=mode), sql=SQLDBConnector())
 
 if __name__ == "__main__":
-    asyncio.run(historical())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+from database.queries import HISTORICAL
+from database.SQLDBConnector import SQLDBConnector
+from database.MongoDBConnector import MongoDBConnector
+
+import argparse
+import asyncio
+import pandas as pd
+from datetime import datetime
+
+PIPELINE_NAME   = "measurements"
+COLL_NAME       = "measurements"
+
+# Watermark of a pipeline that has never run ; pulls the full history
+INITIAL_WATERMARK = {
+    "last_utime"    : datetime(1970, 1, 1),
+    "last_job_id"   : 0
+}
+
+def to_ymd(x):
+    return x.strftime("%Y-%m-%d") if pd.notna(x) else None
+
+def ts_to_ymd_hm(x):
+
+    if not x:
+        return None
+
+    # Unix seconds, or milliseconds for values past year 5138
+    x = int(x)
+    x = x / 1000 if x > 10**11 else x
+
+    return datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M")
+
+async def read_watermark(mongo: MongoDBConnector):
+
+    docs = await mongo.get_all_documents(
+        "watermarks",
+        query = {"_id": PIPELINE_NAME},
+        projection = {"_id": 0, "last_utime": 1, "last_job_id": 1}
+    )
+
+    return {**INITIAL_WATERMARK, **docs[0]} if docs else dict(INITIAL_WATERMARK)
+
+async def write_watermark(mongo: MongoDBConnector, watermark):
+
+    # Single-document update, so a reader sees either the old or the new watermark
+    await mongo.upsert_documents_hashed(
+        [
+            {
+                "pipeline_name" : PIPELINE_NAME,
+                "last_utime"    : watermark["last_utime"],
+                "last_job_id"   : watermark["last_job_id"]
+            }
+        ],
+        coll_name = "watermarks",
+        prefilter = True
+    )
+
+async def measurements(
+
+        mongo       : MongoDBConnector,
+        sql         : SQLDBConnector,
+        chunksize   : int = 5000
+
+) -> None:
+    """
+    Incrementally sync origin_data_record rows into Mongo
+    Rows are pulled in (sync_utime, id) order strictly after the stored watermark, where sync_utime is
+    the later of the record's and its user_detail row's utime (edd / add come from user_detail),
+    and last_utime / last_job_id are the sync_utime and id of the last record synced
+    The watermark advances after every chunk is upserted, so an interrupted run resumes from its last chunk
+    """
+
+    watermark = await read_watermark(mongo)
+
+    print(f"---MEASUREMENTS ({mongo.mode}, since {watermark['last_utime']} / {watermark['last_job_id']})---")
+
+    n_synced = 0
+
+    async for rows in sql.aiter_query(HISTORICAL, chunksize=chunksize, params=watermark, as_records=True):
+
+        records = []
+        for row in rows:
+
+            records.append({
+                "_id"               : row["id"],
+                "mobile"            : row["mobile"],
+                "start_ts"          : row["start_ts"],
+                "start_test_ts"     : row["start_test_ts"],
+                "contraction_url"   : row["contraction_url"],
+                "hb_baby_url"       : row["hb_baby_url"],
+                "raw_fetal_url"     : row["raw_fetal_url"],
+                "basic_info"        : row["basic_info"],
+                "conclusion"        : row["conclusion"],
+                "record_utime"      : row["utime"],
+                "edd"               : to_ymd(row["expected_born_date"]),
+                "add"               : ts_to_ymd_hm(row["end_born_ts"]),
+                "onset"             : None
+            })
+
+        counts = await mongo.upsert_documents_hashed(records, coll_name=COLL_NAME, prefilter=True)
+
+        # Never move the watermark past records that were not written
+        if counts["failed"]:
+            raise RuntimeError(f"{counts['failed']} measurements failed to upsert: {counts['failed_ids'][:10]}")
+
+        last = rows[-1]
+        watermark = {"last_utime": last["sync_utime"], "last_job_id": last["id"]}
+        await write_watermark(mongo, watermark)
+
+        n_synced += len(records)
+        print(
+            f"[Mongo] {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged"
+            f" ; {n_synced} synced (watermark {watermark['last_utime']} / {watermark['last_job_id']})"
+        )
+
+    print(f"Measurements: {n_synced} changed measurements upserted")
+
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, required=True, choices=["local", "remote", 'test'])
+    mode = parser.parse_args().mode
+
+    with SQLDBConnector() as sql:
+        await measurements(mongo=MongoDBConnector(mode=mode), sql=sql)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -8,50 +8,57 @@ import asyncio
 import numpy as np
 import pandas as pd
 
-async def recruited():
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", required=True, choices=['local', 'remote', 'test'])
-    mode = parser.parse_args().mode
-
-    print(f"---RECRUITED ({mode})---")
-
-    sql   = SQLDBConnector()
-    mongo = MongoDBConnector(mode=mode)
-
-    pre_docs = await mongo.get_all_documents(
-        "patient_presurvey",
-        projection = {
-            "_id"                   : 0,
-            "name"                  : 1,
-            "mobile"                : 1,
-            "age"                   : 1,
-            "curr_height"           : 1,
-            "pre_weight"            : 1,
-            "edd"                   : 1,
-            "had_pregnancy"         : 1,
-            "had_preterm"           : 1,
-            "had_surgery"           : 1,
-            "diagnosed_conditions"  : 1,
-        }
+PRE_FIELDS = [
+    "name",
+    "mobile",
+    "age",
+    "curr_height",
+    "pre_weight",
+    "edd",
+    "had_pregnancy",
+    "had_preterm",
+    "had_surgery",
+    "diagnosed_conditions",
+]
+
+POST_FIELDS = [
+    "delivery_type",
+    "add",
+    "delivery_time",
+    "water_break_datetime",
+]
+
+YES_NO = pd.CategoricalDtype(["Yes", "No", "NA"])
+
+PRE_DTYPES = {
+    "age"           : "Int64",
+    "had_pregnancy" : YES_NO,
+    "had_preterm"   : YES_NO,
+    "had_surgery"   : YES_NO,
+}
+
+async def recruited(
+
+        mongo   : MongoDBConnector,
+        sql     : SQLDBConnector
+
+) -> None:
+
+    print(f"---RECRUITED ({mongo.mode})---")
+
+    # Pre/post survey left join runs inside MongoDB ; only the projected fields cross the network
+    merged = await mongo.batches_to_dataframe(
+        mongo.stream_survey_join(pre_fields=PRE_FIELDS, post_fields=POST_FIELDS),
+        columns = PRE_FIELDS + POST_FIELDS,
+        dtypes = PRE_DTYPES
     )
 
-    post_docs = await mongo.get_all_documents(
-        "patient_postsurvey",
-        projection = {
-            "_id"                   : 0,
-            "mobile"                : 1,
-            "delivery_type"         : 1,
-            "add"                   : 1,
-            "delivery_time"         : 1,
-            "water_break_datetime"  : 1
-        }
+    measurements_df     = await asyncio.to_thread(
+        sql.query_in_chunks,
+        query   = RECRUITED_PATIENTS_QUERY,
+        key     = "mobiles",
+        values  = merged["mobile"].tolist()
     )
-
-    pre = pd.DataFrame(pre_docs) ; post = pd.DataFrame(post_docs)
-
-    mobile_query_str    = ",".join([f"'{i['mobile']}'" for i in pre_docs])
-    measurements_df     = sql.query_to_dataframe(query=RECRUITED_PATIENTS_QUERY.format(mobile_query_str=mobile_query_str))
     measurements_df     = measurements_df.sort_values(["mobile", "m_time"])
     grouped_df          = measurements_df.groupby("mobile")
 
@@ -63,18 +70,17 @@ async def recruited():
     """
     queried_mobile_set = set([mobile for mobile, _ in grouped_df])
 
-    print(f"[Mongo] {len(pre_docs)} pre-survey records")
+    print(f"[Mongo] {len(merged)} pre-survey records")
 
-    print(f"[Mongo] {len(post_docs)} post-survey records")
+    print(f"[Mongo] {int(merged[POST_FIELDS].notna().any(axis=1).sum())} with post-survey records")
 
-    for d in pre_docs:
+    for mobile in merged["mobile"]:
 
-        if d['mobile']  not in queried_mobile_set:
-            print(f"[MySQL] {d['mobile']}: Not registered on Modoo / No measurement data")
+        if mobile not in queried_mobile_set:
+            print(f"[MySQL] {mobile}: Not registered on Modoo / No measurement data")
 
     print(f'[MySQL] {len(queried_mobile_set)} patients from MySQL')
 
-    merged = pre.merge(post, on="mobile", how="left")
     merged.replace({np.nan: None}, inplace=True)
 
     new_records = []
@@ -188,13 +194,21 @@ async def recruited():
 
         new_records.append(record)
 
-        await mongo.upsert_documents(
-            new_records,
-            coll_name = "patients_unified",
-            id_fields = ["mobile"]
-        )
+    await mongo.upsert_documents(
+        new_records,
+        coll_name = "patients_unified",
+        id_fields = ["mobile"]
+    )
 
     print(f"Recruited: {len(new_records)} consolidated patients upserted")
 
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", required=True, choices=['local', 'remote', 'test'])
+    mode = parser.parse_args().mode
+
+    await recruited(mongo=MongoDBConnector(mode=mode), sql=SQLDBConnector())
+
 if __name__ == "__main__":
-    asyncio.run(recruited())
\ No newline at end of file
+    asyncio.run(main())
@@ -16,17 +16,14 @@ from pathlib import Path
 # pre_collection  = db["patient_presurvey"]
 # post_collection = db["patient_postsurvey"]
 
-async def upsert():
+async def upsert(
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", type=str, required=True, default="local")
-    parser.add_argument('--date', type=str, required=False, default=datetime.today().strftime("%y%m%d"))
-    args = parser.parse_args()
-    mode = args.mode ; date = args.date
+        mongo   : MongoDBConnector,
+        date    : str
 
-    print(f"---UPSERT SURVEYS ({mode}, {date})---")
+) -> None:
 
-    mongo = MongoDBConnector(mode=args.mode)
+    print(f"---UPSERT SURVEYS ({mongo.mode}, {date})---")
 
     ROOT    = Path(__file__).parent.parent
     PRE_IN  = ROOT / "datasets" / f"{date}_pre_survey.csv"
@@ -312,5 +309,14 @@ async def upsert():
     print(f"Upserted {len(pre_unique_records)} records into MongoDB collection 'patient_presurvey'")
     print(f"Upserted {len(post_unique_records)} records into MongoDB collection 'patient_postsurvey'")
 
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, required=True, default="local")
+    parser.add_argument('--date', type=str, required=False, default=datetime.today().strftime("%y%m%d"))
+    args = parser.parse_args()
+
+    await upsert(mongo=MongoDBConnector(mode=args.mode), date=args.date)
+
 if __name__ == "__main__":
-    asyncio.run(upsert())
\ No newline at end of file
+    asyncio.run(main())
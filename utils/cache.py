@@ -0,0 +1,257 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+from typing import Optional, Union
+
+# Relative to the working directory, like ./datasets
+DEFAULT_CACHE_DIR   = ".trace_cache"
+DEFAULT_MAX_BYTES   = 2 * 1024 ** 3
+
+TEXT_SUFFIX     = ".txt"
+ARRAY_SUFFIX    = ".npy"
+META_SUFFIX     = ".json"
+
+class TraceCache:
+    """
+    Content-addressed on-disk cache of decoded traces, keyed by the sha256 of the URL
+    Traces are immutable once recorded, so an entry never goes stale and is only dropped by eviction
+
+    Text is stored as the decompressed UTF-8 body, arrays as .npy (read back with np.load / mmap_mode)
+    Writes go to a temp file in the same directory and are renamed into place, so readers never see
+    a partial entry ; once the cache exceeds `max_bytes` the least recently used entries are evicted
+
+    The ETag / Last-Modified a trace was served with are kept next to each copy (<key>.txt.json /
+    <key>.npy.json), so refreshing one copy never makes the other look current
+    """
+
+    def __init__(
+
+            self,
+            cache_dir   : str = DEFAULT_CACHE_DIR,
+            max_bytes   : int = DEFAULT_MAX_BYTES
+
+    ):
+
+        self.cache_dir  = cache_dir
+        self.max_bytes  = max_bytes
+
+        self.hits       = 0
+        self.misses     = 0
+        self.writes     = 0
+        self.evictions  = 0
+
+        # Lookups and writes run in worker threads (asyncio.to_thread)
+        self._lock      = threading.Lock()
+        self._size      = None
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def path(self, url: str, as_array: bool = False) -> str:
+
+        key = self.key(url)
+        # Two-level fan-out keeps directories small for hundreds of thousands of traces
+        return os.path.join(self.cache_dir, key[:2], key + (ARRAY_SUFFIX if as_array else TEXT_SUFFIX))
+
+    def meta_path(self, url: str, as_array: bool = False) -> str:
+        return self.path(url, as_array) + META_SUFFIX
+
+    def _entries(self, suffixes=(TEXT_SUFFIX, ARRAY_SUFFIX)):
+
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(suffixes):
+                    yield os.path.join(root, name)
+
+    @staticmethod
+    def _file_size(p: str) -> int:
+
+        try:
+            return os.path.getsize(p)
+        except FileNotFoundError:
+            return 0
+
+    def size(self) -> int:
+        """
+        Bytes of traces and their validator files ; walked once, then kept as a running total
+        """
+
+        with self._lock:
+
+            if self._size is None:
+                total = 0
+                for p in self._entries((TEXT_SUFFIX, ARRAY_SUFFIX, META_SUFFIX)):
+                    try:
+                        total += os.path.getsize(p)
+                    except FileNotFoundError:
+                        pass
+                self._size = total
+
+            return self._size
+
+    def get(self, url: str, as_array: bool = False) -> Optional[Union[str, np.ndarray]]:
+
+        p = self.path(url, as_array)
+
+        try:
+            if as_array:
+                value = np.load(p, allow_pickle=False)
+            else:
+                with open(p, "rb") as f:
+                    value = f.read().decode("utf-8")
+
+            # mtime is the LRU clock
+            os.utime(p)
+
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return value
+
+    def get_validators(self, url: str, as_array: bool = False) -> Optional[dict]:
+
+        try:
+            with open(self.meta_path(url, as_array), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    @staticmethod
+    def _write_atomic(p: str, write) -> int:
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p), suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+
+            n_bytes = os.path.getsize(tmp)
+            os.replace(tmp, p)
+
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return n_bytes
+
+    def put(self, url: str, value: Union[str, np.ndarray], validators: Optional[dict] = None) -> None:
+
+        as_array = isinstance(value, np.ndarray)
+        p = self.path(url, as_array)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+
+        # Initialise the running total before the new files land on disk, or the walk would count them too
+        self.size()
+
+        replaced = self._file_size(p)
+
+        def write(f):
+            if as_array:
+                np.save(f, value, allow_pickle=False)
+            else:
+                f.write(value.encode("utf-8"))
+
+        n_bytes = self._write_atomic(p, write)
+
+        if validators:
+            meta = self.meta_path(url, as_array)
+            replaced += self._file_size(meta)
+            n_bytes  += self._write_atomic(meta, lambda f: f.write(json.dumps(validators).encode("utf-8")))
+
+        with self._lock:
+            self._size  += n_bytes - replaced
+            self.writes += 1
+            over = self._size > self.max_bytes
+
+        if over:
+            self.evict()
+
+    def evict(self, target: Optional[int] = None) -> int:
+        """
+        Delete least recently used entries until the cache is at or below `target` bytes
+        (90% of max_bytes by default, so a full cache does not evict on every write)
+        """
+
+        target = int(self.max_bytes * 0.9) if target is None else target
+
+        entries = []
+        size    = 0
+        for p in self._entries((TEXT_SUFFIX, ARRAY_SUFFIX, META_SUFFIX)):
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            if not p.endswith(META_SUFFIX):
+                entries.append((st.st_mtime, p))
+
+            # Validators whose trace is gone (or from the old shared <key>.json layout)
+            elif not os.path.exists(p[:-len(META_SUFFIX)]):
+                try:
+                    os.remove(p)
+                    size -= st.st_size
+                except FileNotFoundError:
+                    pass
+
+        n_evicted = 0
+
+        for _, p in sorted(entries):
+
+            if size <= target:
+                break
+
+            # Validators go with their copy
+            for q in (p, p + META_SUFFIX):
+                n_bytes = self._file_size(q)
+                try:
+                    os.remove(q)
+                    size -= n_bytes
+                except FileNotFoundError:
+                    pass
+
+            n_evicted += 1
+
+        with self._lock:
+            self._size      = size
+            self.evictions += n_evicted
+
+        return n_evicted
+
+    def stats(self) -> dict:
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits"      : self.hits,
+            "misses"    : self.misses,
+            "hit_rate"  : self.hits / lookups if lookups else 0.0,
+            "writes"    : self.writes,
+            "evictions" : self.evictions,
+            "bytes"     : self.size(),
+            "max_bytes" : self.max_bytes,
+        }
+
+_default_cache = None
+
+def default_cache() -> TraceCache:
+    """
+    Process-wide cache under ./.trace_cache, shared by every downloader that does not get its own
+    """
+
+    global _default_cache
+
+    if _default_cache is None:
+        _default_cache = TraceCache()
+
+    return _default_cache
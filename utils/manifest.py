@@ -0,0 +1,138 @@
+import time
+import sqlite3
+import threading
+
+from typing import Dict, Iterable, List, Optional
+
+# Relative to the working directory, next to ./.trace_cache
+DEFAULT_MANIFEST_PATH = "download_manifest.sqlite"
+
+STATUS_DONE     = "done"
+STATUS_FAILED   = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    url         TEXT PRIMARY KEY,
+    status      TEXT NOT NULL,
+    bytes       INTEGER,
+    checksum    TEXT,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    updated_at  REAL NOT NULL
+)
+"""
+
+class DownloadManifest:
+    """
+    Persistent record of every trace download attempted : status (done / failed), size and sha256 of
+    the compressed body as served (the same whether it was decoded to text or samples) and how many
+    HTTP requests it took over all runs, one row per URL in a SQLite file
+
+    A backfill that caches what it downloads can be rerun with
+    TraceDownloader(manifest=..., cache=...).fetch_all(..., resume=True) : URLs done last time are
+    served from the cache, and only those missing from it, from the manifest or failed are fetched
+    """
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH):
+
+        self.path = path
+
+        # Written from worker threads (asyncio.to_thread) ; one connection, serialized
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        # WAL keeps per-URL commits cheap and lets another process read the manifest mid-run
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+
+    def close(self) -> None:
+
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(
+
+            self,
+            url         : str,
+            ok          : bool,
+            n_bytes     : Optional[int] = None,
+            checksum    : Optional[str] = None,
+            attempts    : int = 1
+
+    ) -> None:
+        """
+        Record one download run of `url` : whether it succeeded, the compressed body it decoded
+        (None if no body was read, e.g. a 304 or a failure ; the previous values are kept) and the
+        HTTP requests it sent
+        """
+
+        status = STATUS_DONE if ok else STATUS_FAILED
+
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO downloads (url, status, bytes, checksum, attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    status      = excluded.status,
+                    bytes       = COALESCE(excluded.bytes, downloads.bytes),
+                    checksum    = COALESCE(excluded.checksum, downloads.checksum),
+                    attempts    = downloads.attempts + excluded.attempts,
+                    updated_at  = excluded.updated_at
+                """,
+                (url, status, n_bytes, checksum, attempts, time.time())
+            )
+
+    def statuses(self, urls: Iterable[str]) -> Dict[str, str]:
+
+        urls = [u for u in dict.fromkeys(urls) if u is not None]
+        out = {}
+
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(urls), 900):
+                chunk = urls[i:i + 900]
+                rows = self._conn.execute(
+                    f"SELECT url, status FROM downloads WHERE url IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                out.update(rows)
+
+        return out
+
+    def pending(self, urls_indexed: List[tuple]) -> List[tuple]:
+        """
+        The (idx, url) pairs still to fetch : missing from the manifest or failed last time
+        """
+
+        statuses = self.statuses(url for _, url in urls_indexed)
+
+        return [(idx, url) for idx, url in urls_indexed if statuses.get(url) != STATUS_DONE]
+
+    def get(self, url: str) -> Optional[dict]:
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, status, bytes, checksum, attempts, updated_at FROM downloads WHERE url = ?",
+                (url,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(("url", "status", "bytes", "checksum", "attempts", "updated_at"), row))
+
+    def summary(self) -> dict:
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*), COALESCE(SUM(bytes), 0) FROM downloads GROUP BY status"
+            ).fetchall()
+
+        return {status: {"urls": n, "bytes": n_bytes} for status, n, n_bytes in rows}
@@ -1,11 +1,24 @@
+from utils.cache import TraceCache, default_cache
+from utils.manifest import DownloadManifest, STATUS_DONE
+from utils.trace_store import CHANNELS
+
 import io
 import json
 import gzip
+import zlib
 import asyncio
 import aiohttp
 import ssl
 import certifi
 import random
+import functools
+import hashlib
+import time
+import numpy as np
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from typing import Optional
 
@@ -25,6 +38,14 @@ RETRYABLE_STATUSES = {
     504     # Gateway timeout, no response from upstream server in time
 }
 
+# Responses that mean the host is overloaded or throttling us ; these shrink the adaptive limit
+THROTTLE_STATUSES = {429, 503}
+
+THROTTLE_EXC = (
+    asyncio.TimeoutError,
+    aiohttp.ServerTimeoutError,
+)
+
 RETRYABLE_EXC = (
     asyncio.TimeoutError,
     aiohttp.ServerTimeoutError,
@@ -34,97 +55,764 @@ RETRYABLE_EXC = (
     aiohttp.TooManyRedirects,
 )
 
+# Samples are small integers (UC 0-100, FHR bpm, FMOV marks) ; int16 holds all of them
+TRACE_DTYPE = np.int16
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Returned by a revalidating reader on 304 ; the cached copy is still current
+NOT_MODIFIED = object()
+
 def jittered_backoff(attempt, base=2, cap=60):
     return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0)
 
+def parse_retry_after(value) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, given either as delta-seconds or as an HTTP-date
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for downloads that adapts to the host (AIMD, as in TCP congestion control)
+
+    - Slow start : the limit grows by one per success (doubling every round) until the first throttle
+    - Additive increase : afterwards it grows by one after `limit` consecutive successes
+    - Multiplicative decrease : a 429/503/timeout multiplies it by `decrease`, at most once per `cooldown`
+      seconds, so a burst of concurrent throttles counts as one congestion signal
+    - Retry-After pauses every new request, not just the one that received it
+    - The limit only grows while it is actually being used (a slot was taken at limit - 1 or more in flight),
+      so sequential or low-volume traffic does not drift it up to `max_limit` ahead of the next burst
+
+    Used like a semaphore around each attempt, reporting its outcome before releasing:
+
+    async with limiter:
+        ...
+        limiter.on_success()
+    """
+
+    def __init__(
+
+            self,
+            initial     : int = 16,
+            min_limit   : int = 1,
+            max_limit   : int = 128,
+            decrease    : float = 0.5,
+            cooldown    : float = 1.0,
+            window      : int = 200
+
+    ):
+
+        self.min_limit  = min_limit
+        self.max_limit  = max_limit
+        self.decrease   = decrease
+        self.cooldown   = cooldown
+        self.limit      = max(min_limit, min(initial, max_limit))
+
+        self.in_flight      = 0
+        self.peak_limit     = self.limit
+        self.successes      = 0
+        self.throttles      = 0
+        self.errors         = 0
+
+        self._slow_start    = True
+        self._saturated     = False
+        self._since_growth  = 0
+        self._last_decrease = float("-inf")
+        self._paused_until  = 0.0
+        # Outcomes of the most recent `window` attempts, True for success
+        self._recent        = deque(maxlen=window)
+        self._cond          = None
+
+    def _condition(self) -> asyncio.Condition:
+
+        # Created lazily so the limiter can be built outside a running loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self) -> None:
+
+        cond = self._condition()
+
+        async with cond:
+            while True:
+
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    if self.in_flight >= self.limit - 1:
+                        self._saturated = True
+                    return
+
+                await cond.wait()
+
+    async def release(self) -> None:
+
+        # Decrement before awaiting the lock, so a cancelled download never leaks its slot
+        self.in_flight -= 1
+
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+    def on_success(self) -> None:
+
+        self.successes += 1
+        self._recent.append(True)
+
+        # Successes below the limit say nothing about whether the host could take more
+        if not self._saturated:
+            return
+
+        self._since_growth += 1
+
+        if self._slow_start or self._since_growth >= self.limit:
+            self.limit          = min(self.max_limit, self.limit + 1)
+            self.peak_limit     = max(self.peak_limit, self.limit)
+            self._since_growth  = 0
+            self._saturated     = False
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+
+        self.throttles += 1
+        self._recent.append(False)
+
+        now = time.monotonic()
+
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+        if now - self._last_decrease >= self.cooldown:
+            self.limit          = max(self.min_limit, int(self.limit * self.decrease))
+            self._slow_start    = False
+            self._since_growth  = 0
+            self._last_decrease = now
+
+    def on_error(self) -> None:
+
+        # Failures that say nothing about load (resets, bad payloads) are counted but keep the limit
+        self.errors += 1
+        self._recent.append(False)
+
+    def stats(self) -> dict:
+
+        return {
+            "concurrency"   : self.limit,
+            "peak"          : self.peak_limit,
+            "in_flight"     : self.in_flight,
+            "successes"     : self.successes,
+            "throttles"     : self.throttles,
+            "errors"        : self.errors,
+            "error_rate"    : self._recent.count(False) / len(self._recent) if self._recent else 0.0,
+            "paused_for"    : max(0.0, self._paused_until - time.monotonic()),
+        }
+
+def parse_samples(data: bytes, dtype=TRACE_DTYPE) -> np.ndarray:
+    """
+    Parse newline-separated numeric samples straight into an array, without a str or list-of-str in between
+    Falls back to a float parse (cast to `dtype`) if any sample has a decimal point
+    """
+
+    try:
+        return np.fromstring(data, dtype=dtype, sep="\n")
+    except ValueError:
+        return np.fromstring(data, dtype=np.float64, sep="\n").astype(dtype)
+
+def gunzip_text(content: bytes) -> str:
+    return gzip.decompress(content).decode('utf-8')
+
+def gunzip_samples(content: bytes, dtype=TRACE_DTYPE) -> np.ndarray:
+    return parse_samples(gzip.decompress(content), dtype)
+
+class BodyDigest:
+    """
+    Size and sha256 of a compressed body, fed the raw bytes by the reader as they are received
+    """
+
+    def __init__(self):
+
+        self.n_bytes    = 0
+        self._sha       = hashlib.sha256()
+
+    def update(self, data: bytes) -> None:
+
+        self.n_bytes += len(data)
+        self._sha.update(data)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+async def read_text(response, digest=None):
+
+    content = await response.read()
+    if digest is not None:
+        digest.update(content)
+    with gzip.open(io.BytesIO(content)) as f:
+        return f.read().decode('utf-8')
+
+class SampleDecoder:
+    """
+    Incremental gunzip + parse of newline-separated samples : feed() compressed chunks in order, then finish()
+    Only the undecoded tail of the current chunk is kept between feeds
+
+    Bodies made of several gzip members (concatenated .gz files) are decoded member after member,
+    and a body that ends mid-member raises aiohttp.ClientPayloadError, so download_gz retries it
+    """
+
+    def __init__(self, dtype=TRACE_DTYPE):
+
+        self.dtype  = dtype
+        self.parts  = []
+        self.tail   = b""
+
+        self._decomp    = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started   = False
+
+    def _inflate(self, chunk: bytes) -> bytes:
+
+        out = []
+
+        while chunk:
+
+            # Previous member complete ; what follows starts the next one (zero padding is allowed, as in gzip)
+            if self._decomp.eof:
+                chunk = chunk.lstrip(b"\x00")
+                if not chunk:
+                    break
+                self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            out.append(self._decomp.decompress(chunk))
+            chunk = self._decomp.unused_data if self._decomp.eof else b""
+
+        return b"".join(out)
+
+    def feed(self, chunk: bytes) -> None:
+
+        self._started |= bool(chunk)
+        data = self.tail + self._inflate(chunk)
+        cut  = data.rfind(b"\n") + 1
+
+        if cut:
+            self.parts.append(parse_samples(data[:cut], self.dtype))
+            self.tail = data[cut:]
+        else:
+            self.tail = data
+
+    def finish(self) -> np.ndarray:
+
+        self.tail += self._decomp.flush()
+
+        # An empty body is an empty trace, as with gzip.decompress
+        if self._started and not self._decomp.eof:
+            raise aiohttp.ClientPayloadError("Truncated gzip body : stream ended before the end of the member")
+
+        if self.tail.strip():
+            self.parts.append(parse_samples(self.tail, self.dtype))
+        self.tail = b""
+
+        return np.concatenate(self.parts) if self.parts else np.empty(0, dtype=self.dtype)
+
+async def read_samples(response, dtype=TRACE_DTYPE, digest=None):
+    """
+    Gunzip the body incrementally as chunks arrive and parse every complete line into `dtype` samples
+    """
+
+    decoder = SampleDecoder(dtype)
+
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_BYTES):
+        if digest is not None:
+            digest.update(chunk)
+        decoder.feed(chunk)
+
+    return decoder.finish()
+
 async def download_gz(
     sem,
     session,
     max_retries,
     url_indexed,
+    reader = read_text,
+    headers = None,
+    stats = None,
 ):
+    """
+    (idx, decoded body), or (idx, None) if the URL is missing, not retryable or out of retries
+    `sem` is held for each attempt only, never across a backoff sleep ; an AdaptiveLimiter
+    is also told how each attempt went
+    A `stats` dict gets "attempts", the number of requests actually sent
+    """
 
     idx, url = url_indexed[0], url_indexed[1]
 
     if url is None:
         return idx, None
 
-    # Semaphore limit
-    async with sem:
+    limiter = sem if isinstance(sem, AdaptiveLimiter) else None
+
+    for attempt in range(1, max_retries + 1):
+
+        delay = None
 
-        for attempt in range(1, max_retries + 1):
+        async with sem:
+
+            if stats is not None:
+                stats["attempts"] = attempt
 
             try:
-                async with session.get(url) as response:
+                async with session.get(url, headers=headers) as response:
 
                     status = response.status
                     if status in RETRYABLE_STATUSES:
-                        retry_after = response.headers.get('Retry-After')
-                        delay = float(retry_after) if retry_after else jittered_backoff(attempt)
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        delay = retry_after if retry_after is not None else jittered_backoff(attempt)
                         # Return socket to pool
                         await response.release()
-                        # Wait a while before continuing with the next attempt
-                        await asyncio.sleep(delay)
-                        continue
 
-                    response.raise_for_status()
-                    content = await response.read()
-                    with gzip.open(io.BytesIO(content)) as f:
-                        return idx, f.read().decode('utf-8')
+                        if limiter is not None:
+                            if status in THROTTLE_STATUSES:
+                                limiter.on_throttle(retry_after)
+                            else:
+                                limiter.on_error()
+
+                    else:
+                        response.raise_for_status()
+                        result = await reader(response)
+
+                        if limiter is not None:
+                            limiter.on_success()
+
+                        return idx, result
 
             except RETRYABLE_EXC as e:
-                msg = f"{idx}: Retryable error exhausted ({type(e).__name__}\n{e}"
-                print(msg)
+                print(f"{idx}: Retryable error, attempt {attempt}/{max_retries} ({type(e).__name__}\n{e}")
                 delay = jittered_backoff(attempt)
-                await asyncio.sleep(delay)
+
+                if limiter is not None:
+                    if isinstance(e, THROTTLE_EXC):
+                        limiter.on_throttle()
+                    else:
+                        limiter.on_error()
 
             except aiohttp.ClientResponseError as e:
-                msg = f"{idx}: HTTP {e.status}\n{e.message}"
-                print(msg)
+                print(f"{idx}: HTTP {e.status}\n{e.message}")
+                if limiter is not None:
+                    limiter.on_error()
+                return idx, None
 
             except Exception as e:
-                msg = f"{idx}: Unexpected {type(e).__name__}\n{e}"
-                print(msg)
-
-async def process_urls(urls_indexed):
-
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    connector = aiohttp.TCPConnector(
-        limit                   = 64,
-        use_dns_cache           = True,
-        ttl_dns_cache           = 300,
-        keepalive_timeout       = 30,
-        enable_cleanup_closed   = True,
-        ssl                     = ssl_context,
-        force_close             = False
-    )
+                print(f"{idx}: Unexpected {type(e).__name__}\n{e}")
+                if limiter is not None:
+                    limiter.on_error()
+                return idx, None
 
-    session_timeout = aiohttp.ClientTimeout(total=180)
+        # Wait a while before continuing with the next attempt, without holding a slot
+        if attempt < max_retries:
+            await asyncio.sleep(delay)
 
-    semaphore = asyncio.Semaphore(128)
+    print(f"{idx}: Retries exhausted after {max_retries} attempts")
+    return idx, None
 
-    client_session = aiohttp.ClientSession(
-        connector   = connector,
-        timeout     = session_timeout,
-    )
+class TraceDownloader:
+    """
+    One aiohttp session, one TCP connector and one concurrency budget shared by every trace download
+    UC, FHR and FMOV batches submitted to the same downloader reuse its connections and DNS/TLS state,
+    and together never exceed `concurrency` in-flight requests
+
+    With `adaptive`, the in-flight limit starts at `initial_concurrency` and is tuned by an AdaptiveLimiter
+    (at most `concurrency`), shrinking when the host throttles and growing back while requests succeed ;
+    `dl.limiter.stats()` reports the current concurrency and error rate
+
+    async with TraceDownloader() as dl:
+        uc, fhr = await asyncio.gather(dl.fetch_all(uc_indexed), dl.fetch_all(fhr_indexed))
+
+    With `decode_workers` > 0, gunzip and parsing run in a bounded thread (or process) pool
+    so the event loop keeps servicing sockets ; 0 decodes inline on the loop
+    Arrays on a thread pool are still decoded as the body streams in ; a process pool (and text)
+    first reads the whole compressed body
+
+    With a `cache`, decoded traces are looked up on disk before any request and stored after a download
+    With a `manifest`, every download run is recorded (status, compressed size and checksum, attempts)
+    so that fetch_all(..., resume=True) can serve URLs downloaded by an earlier run from the cache
+
+    Concurrent fetches of the same URL share one request and one decoded result (treat it as read-only)
+    With `revalidate`, a cached trace is only used after a conditional GET (If-None-Match /
+    If-Modified-Since) answers 304, or if that request fails ; entries cached without an ETag or
+    Last-Modified are used as is
+    """
+
+    def __init__(
+
+            self,
+            limit           : int = 64,
+            concurrency     : int = 128,
+            max_retries     : int = 3,
+            timeout         : float = 180,
+            decode_workers  : int = 4,
+            decode_executor : str = "thread",
+            cache           : Optional[TraceCache] = None,
+            adaptive        : bool = True,
+            initial_concurrency : int = 16,
+            manifest        : Optional[DownloadManifest] = None,
+            revalidate      : bool = False
+
+    ):
 
-    tasks, results  = [], []
+        self.limit              = limit
+        self.concurrency        = concurrency
+        self.max_retries        = max_retries
+        self.timeout            = timeout
+        self.decode_workers     = decode_workers
+        self.decode_executor    = decode_executor
+        self.cache              = cache
+        self.adaptive           = adaptive
+        self.initial_concurrency = initial_concurrency
+        self.manifest           = manifest
+        self.revalidate         = revalidate
 
-    async with client_session as session:
+        self.coalesced          = 0
+        self.not_modified       = 0
+        self.revalidation_failed = 0
 
-        for _url_indexed in urls_indexed:
+        self._session   = None
+        self._sem       = None
+        self._pool      = None
+        # (url, as_array, dtype) -> [download task, number of callers waiting on it]
+        self._inflight  = {}
+
+    @property
+    def limiter(self) -> Optional[AdaptiveLimiter]:
+        return self._sem if isinstance(self._sem, AdaptiveLimiter) else None
+
+    async def __aenter__(self):
+
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        connector = aiohttp.TCPConnector(
+            limit                   = self.limit,
+            use_dns_cache           = True,
+            ttl_dns_cache           = 300,
+            keepalive_timeout       = 30,
+            enable_cleanup_closed   = True,
+            ssl                     = ssl_context,
+            force_close             = False
+        )
+
+        self._session = aiohttp.ClientSession(
+            connector   = connector,
+            timeout     = aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+        if self.adaptive:
+            self._sem = AdaptiveLimiter(initial=self.initial_concurrency, max_limit=self.concurrency)
+        else:
+            self._sem = asyncio.Semaphore(self.concurrency)
+
+        if self.decode_workers:
+            executor = ProcessPoolExecutor if self.decode_executor == "process" else ThreadPoolExecutor
+            self._pool = executor(max_workers=self.decode_workers)
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+
+        await self._session.close()
+        self._session = None
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+        if self.limiter is not None and (self.limiter.successes or self.limiter.throttles or self.limiter.errors):
+            stats = self.limiter.stats()
+            print(
+                f"[Downloader] concurrency {stats['concurrency']} (peak {stats['peak']}) ;"
+                f" {stats['successes']} ok, {stats['throttles']} throttled, {stats['errors']} errors"
+                f" ({stats['error_rate']:.0%} of recent attempts failed)"
+            )
+
+        if self.coalesced or self.not_modified or self.revalidation_failed:
+            print(
+                f"[Downloader] {self.coalesced} duplicate fetches coalesced, {self.not_modified} cached traces revalidated (304),"
+                f" {self.revalidation_failed} served from cache after a failed revalidation"
+            )
 
-            # Coroutines are scheduled and start to execute here
-            task = asyncio.create_task(
-                download_gz(
-                    sem         = semaphore,
-                    session     = session,
-                    max_retries = 3,
-                    url_indexed = _url_indexed,
-                )
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(
+                f"[Cache] {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})"
+                f" ; {stats['bytes'] / 1e6:.1f} / {stats['max_bytes'] / 1e6:.0f} MB"
             )
 
-            tasks.append(task)
+    async def _cache_get(self, url, as_array):
+
+        if self.cache is None or url is None:
+            return None
+
+        return await asyncio.to_thread(self.cache.get, url, as_array)
+
+    async def _record(self, url, ok, body, attempts):
+
+        if self.manifest is None or url is None:
+            return
+
+        await asyncio.to_thread(
+            self.manifest.record, url, ok,
+            n_bytes     = body.get("n_bytes"),
+            checksum    = body.get("checksum"),
+            attempts    = attempts
+        )
+
+    async def _cache_put(self, url, value, validators=None):
+
+        if self.cache is None or value is None:
+            return
+
+        try:
+            await asyncio.to_thread(self.cache.put, url, value, validators)
+
+        # A full or read-only disk only costs the cache, not the download
+        except OSError as e:
+            print(f"[Cache] write failed for {url} ({type(e).__name__}: {e})")
+
+    async def _decode_offloaded(self, response, decode, digest=None):
+
+        # Only the compressed body is read on the loop ; it is a fraction of the decoded size
+        content = await response.read()
+        if digest is not None:
+            digest.update(content)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, decode, content)
+
+    async def _read_samples_offloaded(self, response, dtype, digest=None):
+        """
+        read_samples with each decode step run on the thread pool ; one step in flight at a time keeps the
+        decoder state in order, and chunks arriving meanwhile are fed together in the next step
+        """
+
+        loop    = asyncio.get_running_loop()
+        decoder = SampleDecoder(dtype)
+        pending = None
+        chunks  = []
+
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_BYTES):
+
+            chunks.append(chunk)
+            if digest is not None:
+                digest.update(chunk)
+
+            if pending is None or pending.done():
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(self._pool, decoder.feed, b"".join(chunks))
+                chunks  = []
+
+        if pending is not None:
+            await pending
+
+        def finish():
+            decoder.feed(b"".join(chunks))
+            return decoder.finish()
+
+        return await loop.run_in_executor(self._pool, finish)
+
+    def _reader(self, as_array, dtype):
+
+        if self._pool is None:
+            return read_text if not as_array else (lambda response, digest=None: read_samples(response, dtype, digest))
+
+        # Decoder state cannot follow chunks across processes ; a process pool decodes the whole body at once
+        if as_array and isinstance(self._pool, ThreadPoolExecutor):
+            return lambda response, digest=None: self._read_samples_offloaded(response, dtype, digest)
+
+        decode = gunzip_text if not as_array else functools.partial(gunzip_samples, dtype=dtype)
+        return lambda response, digest=None: self._decode_offloaded(response, decode, digest)
+
+    async def _download(self, url, as_array, dtype):
+
+        cached = await self._cache_get(url, as_array)
+
+        headers     = None
+        validators  = {}
+
+        if cached is not None:
+
+            if not self.revalidate:
+                return cached
+
+            known = await asyncio.to_thread(self.cache.get_validators, url, as_array) or {}
+            headers = {k: v for k, v in (
+                ("If-None-Match", known.get("etag")),
+                ("If-Modified-Since", known.get("last_modified")),
+            ) if v}
+
+            # Nothing to revalidate against
+            if not headers:
+                return cached
+
+        reader = self._reader(as_array, dtype)
+
+        # Size and sha256 of the compressed body that was decoded, and the requests it took
+        body    = {}
+        stats   = {}
+
+        async def read(response):
+
+            if response.status == 304:
+                return NOT_MODIFIED
+
+            validators.update({k: v for k, v in (
+                ("etag", response.headers.get("ETag")),
+                ("last_modified", response.headers.get("Last-Modified")),
+            ) if v})
+
+            # Fresh per attempt, so a body cut off mid-read is not hashed into the retry
+            digest = BodyDigest()
+            value  = await reader(response, digest)
+            body.update(n_bytes=digest.n_bytes, checksum=digest.hexdigest())
+
+            return value
+
+        _, value = await download_gz(
+            sem         = self._sem,
+            session     = self._session,
+            max_retries = self.max_retries,
+            url_indexed = (url, url),
+            reader      = read,
+            headers     = headers,
+            stats       = stats,
+        )
+
+        if value is NOT_MODIFIED:
+            self.not_modified += 1
+            value = cached
+
+        # Revalidation failed (4xx, 5xx, retries exhausted) ; the cached copy is still the best we have
+        elif value is None and cached is not None:
+            self.revalidation_failed += 1
+            value = cached
+
+        elif value is not None:
+            await self._cache_put(url, value, validators)
+
+        await self._record(url, value is not None, body, stats.get("attempts", 0))
+
+        return value
+
+    async def _fetch_value(self, url, as_array=False, dtype=TRACE_DTYPE):
+        """
+        Decoded trace at `url` (text, or samples with as_array), or None
+        A fetch of a URL already being downloaded waits for that download instead of issuing another
+        """
+
+        if url is None:
+            return None
+
+        key   = (url, as_array, np.dtype(dtype).str if as_array else None)
+        entry = self._inflight.get(key)
+
+        if entry is None:
+            entry = [asyncio.create_task(self._download(url, as_array, dtype)), 0]
+            self._inflight[key] = entry
+            entry[0].add_done_callback(
+                lambda _, key=key, entry=entry: self._inflight.pop(key) if self._inflight.get(key) is entry else None
+            )
+        else:
+            self.coalesced += 1
+
+        entry[1] += 1
+
+        try:
+            # One caller being cancelled must not cancel the download the others are waiting on
+            return await asyncio.shield(entry[0])
+
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                entry[0].cancel()
+            raise
+
+        finally:
+            entry[1] -= 1
+
+    async def fetch(self, url_indexed):
+
+        idx, url = url_indexed[0], url_indexed[1]
+
+        return idx, await self._fetch_value(url)
+
+    async def fetch_array(self, url_indexed, dtype=TRACE_DTYPE):
+
+        idx, url = url_indexed[0], url_indexed[1]
+
+        samples = await self._fetch_value(url, as_array=True, dtype=dtype)
+
+        return idx, samples, 0 if samples is None else len(samples)
+
+    async def fetch_all(self, urls_indexed, as_array=False, dtype=TRACE_DTYPE, resume=False):
+        """
+        Results in completion order ; (idx, text) or, with as_array, (idx, samples, n_samples)
+        With `resume`, URLs the manifest records as done are served from the cache without a request
+        (not even a revalidation) ; those missing from the cache are fetched again like the rest
+        """
+
+        results = []
+
+        if resume and self.manifest is not None:
+
+            n_total  = len(urls_indexed)
+            statuses = await asyncio.to_thread(self.manifest.statuses, (url for _, url in urls_indexed))
+            done     = [i for i, (_, url) in enumerate(urls_indexed) if statuses.get(url) == STATUS_DONE]
+            cached   = await asyncio.gather(*(self._cache_get(urls_indexed[i][1], as_array) for i in done))
+
+            served = set()
+            for i, value in zip(done, cached):
+                if value is not None:
+                    idx = urls_indexed[i][0]
+                    results.append((idx, value, len(value)) if as_array else (idx, value))
+                    served.add(i)
+
+            urls_indexed = [u for i, u in enumerate(urls_indexed) if i not in served]
+            print(
+                f"[Manifest] {len(done)} of {n_total} URLs already done, {len(served)} served from cache,"
+                f" fetching {len(urls_indexed)}"
+            )
+
+        def fetch(_url_indexed):
+            return self.fetch_array(_url_indexed, dtype) if as_array else self.fetch(_url_indexed)
+
+        # Coroutines are scheduled and start to execute here
+        tasks = [asyncio.create_task(fetch(_url_indexed)) for _url_indexed in urls_indexed]
 
         # Completed tasks are processed here in terms of completion order
         for fut in asyncio.as_completed(tasks):
@@ -133,22 +821,186 @@ async def process_urls(urls_indexed):
 
         return results
 
-async def async_process_df(df):
+async def process_urls(urls_indexed, downloader=None):
+
+    if downloader is not None:
+        return await downloader.fetch_all(urls_indexed)
+
+    # Traces never change once recorded, so repeat runs are served from ./.trace_cache
+    async with TraceDownloader(cache=default_cache()) as dl:
+        return await dl.fetch_all(urls_indexed)
+
+async def async_process_df(df, downloader=None, as_array=False):
+    """
+    Download the UC, FHR and FMOV traces of every row ; each distinct URL is fetched once,
+    however many rows or channels reference it
+    Returns (uc_results, fhr_results, fmov_results) with one (idx, text) or (idx, samples, n_samples)
+    per row, idx being the row position
+    """
+
+    if downloader is None:
+        async with TraceDownloader(cache=default_cache()) as dl:
+            return await async_process_df(df, downloader=dl, as_array=as_array)
+
+    channels = [list(df["contraction_url"]), list(df["hb_baby_url"]), list(df["raw_fetal_url"])]
 
-    uc, fhr, fmov = df["contraction_url"], df["hb_baby_url"], df["raw_fetal_url"]
+    unique = list(dict.fromkeys(url for urls in channels for url in urls if url is not None))
+    print(f"[Downloader] {sum(len(urls) for urls in channels)} trace URLs, {len(unique)} unique")
 
-    uc_indexed      = [(i,j) for i,j in enumerate(uc)]
-    fhr_indexed     = [(i,j) for i,j in enumerate(fhr)]
-    fmov_indexed    = [(i,j) for i,j in enumerate(fmov)]
+    # All three channels share one session and one concurrency budget
+    fetched = await downloader.fetch_all(list(enumerate(unique)), as_array=as_array)
 
-    uc_results, fhr_results, fmov_results = await asyncio.gather(
-        process_urls(uc_indexed),
-        process_urls(fhr_indexed),
-        process_urls(fmov_indexed)
+    by_url = {unique[res[0]]: res for res in fetched}
+
+    def result(idx, url):
+
+        res = by_url.get(url)
+
+        if as_array:
+            return (idx, res[1], res[2]) if res is not None else (idx, None, 0)
+
+        return (idx, res[1] if res is not None else None)
+
+    uc_results, fhr_results, fmov_results = (
+        [result(idx, url) for idx, url in enumerate(urls)] for urls in channels
     )
 
     return uc_results, fhr_results, fmov_results
 
+async def iter_measurements(
+
+        df,
+        downloader  : Optional[TraceDownloader] = None,
+        window      : int = 64,
+        as_array    : bool = False,
+        dtype       = TRACE_DTYPE
+
+):
+    """
+    Yield (idx, uc, fhr, fmov) per row of `df`, in row order, as soon as all three of its traces are ready
+    idx is the row position ; a trace is None if its URL is missing or its download failed
+
+    At most `window` rows are downloading or waiting to be consumed at any time, so memory stays flat
+    however many rows there are ; a slow row only holds back the rows after it, never the downloads
+
+    async for idx, uc, fhr, fmov in iter_measurements(df):
+        ...
+
+    To stop early with a shared downloader, wrap it in contextlib.aclosing so the remaining
+    downloads are cancelled before the downloader closes
+    """
+
+    if downloader is None:
+        async with TraceDownloader(cache=default_cache()) as dl:
+            async for item in iter_measurements(df, downloader=dl, window=window, as_array=as_array, dtype=dtype):
+                yield item
+        return
+
+    async def fetch_row(idx, urls):
+
+        if as_array:
+            results = await asyncio.gather(*(downloader.fetch_array((idx, url), dtype) for url in urls))
+        else:
+            results = await asyncio.gather(*(downloader.fetch((idx, url)) for url in urls))
+
+        return (idx, *(res[1] for res in results))
+
+    rows    = zip(df["contraction_url"], df["hb_baby_url"], df["raw_fetal_url"])
+    pending = deque()
+
+    try:
+        for idx, urls in enumerate(rows):
+
+            pending.append(asyncio.create_task(fetch_row(idx, urls)))
+
+            # Window full ; hand back the oldest row before starting another
+            if len(pending) >= window:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+
+    finally:
+        # Consumer stopped early (break / exception) ; drop the downloads still in flight
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def store_measurements(
+
+        df,
+        store,
+        id_column   : str = "id",
+        downloader  : Optional[TraceDownloader] = None,
+        window      : int = 64,
+        batch_size  : int = 64,
+        resume      : bool = True
+
+) -> int:
+    """
+    Download every row's traces as samples and append them to a TraceStore (utils.trace_store),
+    keyed by df[id_column] (origin_data_record.id) ; returns the number of measurements stored
+
+    A row is stored only if every trace it has a URL for downloaded, so with `resume`
+    a rerun skips stored rows and retries the rest
+    """
+
+    if resume:
+        stored = await asyncio.to_thread(store.stored_ids, df[id_column])
+        df = df[~df[id_column].isin(stored)].reset_index(drop=True)
+
+    urls        = df[["contraction_url", "hb_baby_url", "raw_fetal_url"]].to_numpy()
+    record_ids  = df[id_column].to_numpy()
+
+    batch       = []
+    n_stored    = 0
+    n_failed    = 0
+
+    async def flush(batch):
+
+        # One append + fsync per channel file for the whole batch
+        await asyncio.to_thread(store.put_many, [
+            (record_id, channel, samples)
+            for record_id, *channels in batch
+            for channel, samples in zip(CHANNELS, channels)
+            if samples is not None
+        ])
+
+    async for idx, uc, fhr, fmov in iter_measurements(df, downloader=downloader, window=window, as_array=True, dtype=store.dtype):
+
+        if any(url is not None and samples is None for url, samples in zip(urls[idx], (uc, fhr, fmov))):
+            n_failed += 1
+            continue
+
+        batch.append((record_ids[idx], uc, fhr, fmov))
+
+        if len(batch) >= batch_size:
+            await flush(batch)
+            n_stored += len(batch)
+            batch = []
+
+    if batch:
+        await flush(batch)
+        n_stored += len(batch)
+
+    print(f"[TraceStore] {n_stored} measurements stored, {n_failed} with failed downloads left for a rerun")
+
+    return n_stored
+
+async def async_process_chunks(chunks):
+    """
+    Consume DataFrame chunks (e.g. SQLDBConnector.aiter_query) and download each chunk's traces
+    Yields (chunk, (uc_results, fhr_results, fmov_results)) ; indices are positions within the chunk
+    """
+
+    async with TraceDownloader(cache=default_cache()) as dl:
+
+        async for chunk in chunks:
+
+            chunk = chunk.reset_index(drop=True)
+
+            yield chunk, await async_process_df(chunk, downloader=dl)
+
 async def async_process_urls(
         url_list
 ):
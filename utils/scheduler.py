@@ -0,0 +1,103 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+class Stage:
+
+    def __init__(
+
+            self,
+            name    : str,
+            func    : Callable[[], Awaitable[Any]],
+            inputs  : Optional[Iterable[str]] = None,
+            outputs : Optional[Iterable[str]] = None
+
+    ):
+
+        self.name    = name
+        self.func    = func
+        self.inputs  = set(inputs or [])
+        self.outputs = set(outputs or [])
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+def resolve_dependencies(stages: List[Stage]) -> Dict[str, List[str]]:
+    """
+    A stage depends on every stage that declares one of its inputs as an output
+    Stages writing a common output are serialized in declaration order, so the last one declared
+    wins (e.g. upsert_historical after recruited on mongo:patients_unified) however long each takes ;
+    keep such stages to the write itself so the work before it still overlaps
+    Inputs no stage produces (e.g. files in ./datasets, MySQL) are external and impose no ordering
+    Returns {stage_name: [upstream stage names]}
+    """
+
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate stage names: {names}")
+
+    deps = {}
+    for i, stage in enumerate(stages):
+        deps[stage.name] = [
+            other.name for j, other in enumerate(stages)
+            if other is not stage and (stage.inputs & other.outputs or (j < i and stage.outputs & other.outputs))
+        ]
+
+    # Kahn's algorithm, only to reject cycles before anything runs
+    remaining = {k: set(v) for k, v in deps.items()}
+    ready     = [k for k, v in remaining.items() if not v]
+    while ready:
+        done = ready.pop()
+        for k, v in remaining.items():
+            if done in v:
+                v.discard(done)
+                if not v:
+                    ready.append(k)
+        remaining = {k: v for k, v in remaining.items() if k != done}
+
+    if remaining:
+        raise ValueError(f"Cyclic stage dependencies: {sorted(remaining)}")
+
+    return deps
+
+async def run_stages(
+
+        stages          : List[Stage],
+        max_concurrency : Optional[int] = None
+
+) -> Dict[str, Any]:
+    """
+    Run each stage as soon as all of its upstream stages have finished
+    At most `max_concurrency` stages run at once (unbounded if None)
+    If a stage fails, its downstream stages are cancelled and the first error is raised
+    """
+
+    deps    = resolve_dependencies(stages)
+    sem     = asyncio.Semaphore(max_concurrency or max(len(stages), 1))
+    tasks   : Dict[str, asyncio.Task] = {}
+
+    async def run(stage: Stage):
+
+        upstream = [tasks[name] for name in deps[stage.name]]
+        if upstream:
+            await asyncio.gather(*upstream)
+
+        async with sem:
+            print(f"[Scheduler] {stage.name} started")
+            res = await stage.func()
+            print(f"[Scheduler] {stage.name} finished")
+            return res
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run(stage), name=stage.name)
+
+    try:
+        results = await asyncio.gather(*tasks.values())
+
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    return dict(zip(tasks.keys(), results))
@@ -0,0 +1,232 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Relative to the working directory, like ./.trace_cache
+DEFAULT_STORE_DIR = "trace_store"
+
+CHANNELS = ("uc", "fhr", "fmov")
+
+# Same as utils.query.TRACE_DTYPE ; samples are small integers
+STORE_DTYPE = np.int16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traces (
+    record_id   INTEGER NOT NULL,
+    channel     TEXT NOT NULL,
+    offset      INTEGER NOT NULL,
+    length      INTEGER NOT NULL,
+    PRIMARY KEY (record_id, channel)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT NOT NULL
+);
+"""
+
+class TraceStore:
+    """
+    Decoded UC / FHR / FMOV traces as fixed-dtype samples in one append-only binary file per channel
+    (<root>/<channel>.bin), with a SQLite index of (record_id, channel) -> (offset, length) in samples,
+    record_id being origin_data_record.id
+
+    Reads are np.memmap views into the channel file, so analytics over thousands of measurements
+    neither re-parse text nor load every trace into RAM :
+
+    store = TraceStore()
+    fhr = store.get(record_id, "fhr")                           # memmap view, or None
+    lengths = store.lengths("uc")                               # {record_id: n_samples}, index only
+
+    Samples are appended and flushed before their index row is committed, so a crash leaves at most
+    unreferenced bytes at the end of a file ; re-storing a record appends and repoints its index row
+    """
+
+    def __init__(
+
+            self,
+            root    : str = DEFAULT_STORE_DIR,
+            dtype   = STORE_DTYPE
+
+    ):
+
+        self.root   = root
+        self.dtype  = np.dtype(dtype)
+
+        os.makedirs(root, exist_ok=True)
+
+        # Appends run in worker threads (asyncio.to_thread) ; one connection, serialized
+        self._lock  = threading.RLock()
+        self._conn  = sqlite3.connect(os.path.join(root, "index.sqlite"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+        # A store written with one dtype cannot be read with another
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'dtype'").fetchone()
+        if row is None:
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('dtype', ?)", (self.dtype.str,))
+        elif row[0] != self.dtype.str:
+            raise ValueError(f"Trace store {root} holds {np.dtype(row[0])} samples, not {self.dtype}")
+
+        self._maps = {}
+
+    def close(self) -> None:
+
+        with self._lock:
+            self._maps.clear()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def path(self, channel: str) -> str:
+
+        if channel not in CHANNELS:
+            raise ValueError(f"Unknown channel {channel!r}, expected one of {CHANNELS}")
+
+        return os.path.join(self.root, f"{channel}.bin")
+
+    def put(self, record_id: int, channel: str, samples: np.ndarray) -> None:
+
+        self.put_many([(record_id, channel, samples)])
+
+    def put_measurement(
+
+            self,
+            record_id   : int,
+            uc          : Optional[np.ndarray],
+            fhr         : Optional[np.ndarray],
+            fmov        : Optional[np.ndarray]
+
+    ) -> None:
+        """
+        Store the channels of one measurement ; missing (None) channels are skipped
+        """
+
+        self.put_many([
+            (record_id, channel, samples)
+            for channel, samples in zip(CHANNELS, (uc, fhr, fmov))
+            if samples is not None
+        ])
+
+    def put_many(self, items: Iterable[Tuple[int, str, np.ndarray]]) -> None:
+        """
+        Append (record_id, channel, samples) items and index them in one transaction
+        """
+
+        rows = []
+
+        with self._lock:
+
+            by_channel = {}
+            for record_id, channel, samples in items:
+                by_channel.setdefault(channel, []).append((int(record_id), np.ascontiguousarray(samples, dtype=self.dtype)))
+
+            for channel, entries in by_channel.items():
+
+                with open(self.path(channel), "ab") as f:
+
+                    offset = f.tell() // self.dtype.itemsize
+
+                    for record_id, samples in entries:
+                        f.write(samples.tobytes())
+                        rows.append((record_id, channel, offset, len(samples)))
+                        offset += len(samples)
+
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            if not rows:
+                return
+
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO traces (record_id, channel, offset, length) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.execute("COMMIT")
+
+    def _map(self, channel: str, end: int) -> np.memmap:
+
+        # Remap once the file has grown past what the current map covers
+        mm = self._maps.get(channel)
+        if mm is None or len(mm) < end:
+            mm = np.memmap(self.path(channel), dtype=self.dtype, mode="r")
+            self._maps[channel] = mm
+
+        return mm
+
+    def get(self, record_id: int, channel: str) -> Optional[np.ndarray]:
+        """
+        Read-only memmap view of one trace, or None if it was never stored
+        """
+
+        with self._lock:
+
+            row = self._conn.execute(
+                "SELECT offset, length FROM traces WHERE record_id = ? AND channel = ?",
+                (int(record_id), channel)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            offset, length = row
+            if not length:
+                return np.empty(0, dtype=self.dtype)
+
+            return self._map(channel, offset + length)[offset:offset + length]
+
+    def get_measurement(self, record_id: int) -> Tuple[Optional[np.ndarray], ...]:
+        return tuple(self.get(record_id, channel) for channel in CHANNELS)
+
+    def iter_channel(self, channel: str, record_ids: Optional[List[int]] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        (record_id, memmap view) for every stored trace of `channel`, in file order (sequential reads)
+        """
+
+        with self._lock:
+            index = [
+                (record_id, offset, length)
+                for record_id, offset, length in self._conn.execute(
+                    "SELECT record_id, offset, length FROM traces WHERE channel = ? ORDER BY offset",
+                    (channel,)
+                )
+            ]
+
+        wanted = None if record_ids is None else set(int(r) for r in record_ids)
+
+        for record_id, offset, length in index:
+
+            if wanted is not None and record_id not in wanted:
+                continue
+
+            with self._lock:
+                mm = self._map(channel, offset + length) if length else None
+
+            yield record_id, mm[offset:offset + length] if length else np.empty(0, dtype=self.dtype)
+
+    def lengths(self, channel: str) -> Dict[int, int]:
+        """
+        Samples per stored trace of `channel`, from the index alone
+        """
+
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT record_id, length FROM traces WHERE channel = ?", (channel,)
+            ))
+
+    def stored_ids(self, record_ids: Optional[Iterable[int]] = None) -> set:
+        """
+        Record ids with at least one stored channel (restricted to `record_ids` if given)
+        """
+
+        with self._lock:
+            stored = {r for (r,) in self._conn.execute("SELECT DISTINCT record_id FROM traces")}
+
+        return stored if record_ids is None else stored & {int(r) for r in record_ids}